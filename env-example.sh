@@ -3,3 +3,27 @@ export TRY_URL="https://example.org/"
 export PROXY_DB_PATH="tmp/proxy.db"
 export GEOIP_DB_PATH="tmp/geoip.db"
 export PROXY_SEARCH_THREADS=100
+export PROXY_SEARCH_ENGINE=asyncio
+export PROXY_SEARCH_CONCURRENCY=10000
+export PROXY_SEARCH_MODE=permutation
+export PROXY_SCAN_CURSOR_PATH="tmp/scan_cursor.json"
+export PROXY_SEARCH_PROCESSES=1
+export PROXY_VERIFY_CONCURRENCY=500
+export TRY_CONTENT=""
+export PROXY_VERIFIER=socket
+export GEOIP_RELOAD_INTERVAL=10
+export SNAPSHOT_REFRESH_INTERVAL=5
+export SQLITE_CACHE_SIZE=20000
+export SQLITE_BUSY_TIMEOUT=10000
+export PROXY_UPDATE_BATCH_SIZE=1000
+export PROXY_CHECK_MIN_CONCURRENCY=10
+export PROXY_CHECK_MAX_CONCURRENCY=1000
+export PROXY_CHECK_VERIFY_CONCURRENCY=100
+export ADAPTIVE_TIMEOUT_FACTOR=3.0
+export SEARCH_CONNECT_TIMEOUT=0.5
+export SEARCH_CHECK_TIMEOUT=1.5
+export LIST_CACHE_SIZE=256
+export CHANGE_LOG_RETENTION=86400
+export CHECK_CACHE_TTL=60
+export CHECK_CACHE_SIZE=1024
+export CHECK_MAX_AGE=300
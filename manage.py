@@ -1,19 +1,30 @@
 """
 A manager to run some commands of the service.
 
-prepare_geoip_db - prepares binary geo database from CSV downloaded from
+prepare_geoip_db - prepares binary geo database from CSV (plain or gzipped
+    .csv.gz as it is) downloaded from
     https://db-ip.com/db/download/ip-to-city-lite
+migrate - upgrades the schema of the proxy database (it is also done on the
+    start of the service)
 """
 
 import argparse
 
 from service.geoip import prepare_geoip_db
 from service.log import init_logging
+from service.proxy import migrate, engine
 
 
 init_logging()
 
 
+def print_progress(rows_num, rows_per_sec):
+    """
+    Prints progress of a long command.
+    """
+    print(f"Processed {rows_num} rows ({rows_per_sec:.0f} rows/sec)")
+
+
 def required(arg, message):
     """
     Prints message and stops execution if arg is None.
@@ -25,11 +36,15 @@ def required(arg, message):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('action', choices=('prepare_geoip_db',))
+    parser.add_argument('action', choices=('prepare_geoip_db', 'migrate'))
     parser.add_argument('--path', '-p')
     args = parser.parse_args()
 
     if args.action == 'prepare_geoip_db':
         # Command prepare_geoip_db
         required(args.path, "Path to CSV required (parameter --path/-p).")
-        prepare_geoip_db(args.path)
+        prepare_geoip_db(args.path, progress=print_progress)
+
+    elif args.action == 'migrate':
+        # Command migrate
+        migrate(engine)
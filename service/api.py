@@ -1,17 +1,55 @@
 """
 Flask API for the service.
+
+/list and /geo support conditional GET: /list has the ETag of the data
+version of the snapshot (see get_data_version) and the query, /geo/<host>
+has the version of GeoIP file. A request with a matching If-None-Match gets
+304 without building the response.
+
+/changes?since=<version> is the incremental feed of /list (see
+get_changes): the proxies added, changed or removed since the data version
+the client has.
 """
 
-from flask import Flask, jsonify, redirect, url_for, request
+import os
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import select
+from flask import Flask, Response, jsonify, redirect, url_for, request, \
+                  stream_with_context, json
 
 from .version import __version__
-from .proxy import Proxy, SessionThreadPool
+from .proxy import Proxy, engine
 from .log import init_logging
 from .geoip import GeoipDB
+from .snapshot import ProxySnapshotManager, ProxyRecord, encode_cursor, \
+                      decode_cursor
+from .changes import get_changes
+from . import utils, binary
+
+
+# Maximal number of hosts in one request to POST /geo
+MAX_GEO_HOSTS = 10000
+
+# Maximal number of cached JSON responses of /list
+LIST_CACHE_SIZE = int(os.environ.get('LIST_CACHE_SIZE', '256'))
+
+# How long (in seconds) to keep the results of /check/<proxy> and the
+# maximal number of them
+CHECK_CACHE_TTL = float(os.environ.get('CHECK_CACHE_TTL', '60.0'))
+CHECK_CACHE_SIZE = int(os.environ.get('CHECK_CACHE_SIZE', '1024'))
+
+# /check/<proxy> answers with the state in the database if the update tasks
+# checked the proxy not more than this time (in seconds) ago
+CHECK_MAX_AGE = float(os.environ.get('CHECK_MAX_AGE', '300.0'))
 
 
 init_logging()
-session_pool = SessionThreadPool()
+snapshot_manager = ProxySnapshotManager()
+list_cache = utils.LRUCache(LIST_CACHE_SIZE)
+check_cache = utils.LRUCache(CHECK_CACHE_SIZE, ttl=CHECK_CACHE_TTL)
+check_flight = utils.SingleFlight()
 app = Flask(__name__)
 
 
@@ -28,47 +66,192 @@ def list_():
     """
     Returns list of active proxies.
     """
+    snapshot = snapshot_manager.get()
+    query_hash = hashlib.blake2b(request.query_string, digest_size=16)
+    etag = f"{snapshot.version}-{query_hash.hexdigest()}"
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    # JSON responses are cached by the version and the query
+    cache_key = (snapshot.version, request.query_string)
+    cached = list_cache.get(cache_key)
+    if cached is not None:
+        body, headers = cached
+        response = Response(body, mimetype='application/json',
+                            headers=headers)
+        response.set_etag(etag)
+        return response
+
     count = int(request.args.get('count', '0'))
     country = request.args.get('country', '').upper()
     region = request.args.get('region', '')
     city = request.args.get('city', '')
     score = float(request.args.get('score', '0.0'))
-    ordered = bool(request.args.get('ordered', ''))
+    ordered = request.args.get('ordered', '')
+    max_latency = request.args.get('max_latency', '')
+    after = request.args.get('after', '')
     format_ = request.args.get('format', 'json')
 
-    session = session_pool.get()
-    result = Proxy.list_active(session)
-
-    if country:
-        result = filter(lambda e: e.country == country, result)
-    if region:
-        result = filter(lambda e: e.region == region, result)
-    if city:
-        result = filter(lambda e: e.city == city, result)
-    if score:
-        result = filter(lambda e: e.score >= score, result)
-    if ordered:
-        result = sorted(result, key=lambda e: e.score, reverse=True)
-    if count:
-        result = list(result)[:count]
+    # 'ordered=latency' sorts by latency, any other value - by score
+    if ordered != 'latency':
+        ordered = bool(ordered)
+    max_latency = float(max_latency) if max_latency else None
 
-    if format_ == 'plain':
-        result = map(Proxy.__repr__, result)
-        return '\n'.join(result), 200, {'Content-Type': 'text/plain'}
+    # Pages after a cursor are ordered by score
+    if after:
+        if ordered == 'latency':
+            return jsonify(error="Pagination is ordered by score only"), 400
+        try:
+            after = decode_cursor(after)
+        except ValueError as exc:
+            return jsonify(error=str(exc)), 400
+    else:
+        after = None
+
+    result = snapshot.iterate(country=country, region=region, city=city,
+                              score=score, ordered=ordered, count=count,
+                              max_latency=max_latency, after=after)
+
+    # A page ordered by score gets the cursor of the next page (if the page
+    # is full)
+    headers = {}
+    cursor = None
+    paginated = count and (ordered is True or after is not None)
+    if paginated:
+        result = list(result)
+        if len(result) == count:
+            cursor = encode_cursor(result[-1])
+            headers['X-Next-Cursor'] = cursor
+
+    if format_ == 'bin':
+        # Packed records (see binary.py), a page is packed from the records
+        # found for the cursor
+        if paginated:
+            data = binary.pack(snapshot.version, result)
+        else:
+            data = snapshot.pack(country=country, region=region, city=city,
+                                 score=score, ordered=ordered, count=count,
+                                 max_latency=max_latency, after=after)
+        response = Response(data, mimetype='application/octet-stream',
+                            headers=headers)
+    elif format_ == 'plain':
+        # Streamed line by line
+        response = Response(_stream_plain(result), mimetype='text/plain',
+                            headers=headers)
+    elif format_ == 'ndjson':
+        # Streamed as one JSON object per line
+        response = Response(stream_with_context(_stream_ndjson(result)),
+                            mimetype='application/x-ndjson', headers=headers)
     else:
-        result = map(Proxy.as_dict, result)
-        return jsonify(result=list(result))
+        result = map(ProxyRecord.as_dict, result)
+        response = jsonify(result=list(result), cursor=cursor)
+        response.headers.extend(headers)
+        list_cache.put(cache_key, (response.get_data(), headers))
+    response.set_etag(etag)
+    return response
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def _stream_plain(records):
+    sep = ''
+    for record in records:
+        yield f"{sep}{record!r}"
+        sep = '\n'
+
+
+def _stream_ndjson(records):
+    for record in records:
+        yield json.dumps(record.as_dict()) + '\n'
+
+
+@app.route('/random')
+def random_():
+    """
+    Returns 'n' different active proxies drawn at random in proportion to
+    their score.
+    """
+    n = int(request.args.get('n', '1'))
+    country = request.args.get('country', '').upper()
+    region = request.args.get('region', '')
+    city = request.args.get('city', '')
+    score = float(request.args.get('score', '0.0'))
+    format_ = request.args.get('format', 'json')
+
+    if n < 0:
+        return jsonify(error="'n' must not be negative"), 400
+
+    snapshot = snapshot_manager.get()
+    result = snapshot.sample(n, country=country, region=region, city=city,
+                             score=score)
+    if format_ == 'plain':
+        return Response('\n'.join(map(repr, result)), mimetype='text/plain')
+    return jsonify(result=[record.as_dict() for record in result])
+
+
+@app.route('/changes')
+def changes():
+    """
+    Returns the changes of the list of active proxies since the data version
+    'since', or the full list if 'since' is missing or too old.
+    """
+    since = request.args.get('since', '')
+    try:
+        since = int(since) if since else None
+    except ValueError:
+        return jsonify(error="'since' must be an integer"), 400
+
+    result = get_changes(engine, since)
+    return jsonify(
+        version=result.version,
+        full=result.full,
+        upserted=[record.as_dict() for record in result.upserted],
+        removed=[{'host': host, 'port': port}
+                 for host, port in result.removed],
+    )
 
 
 @app.route('/check/<proxy>')
 def check(proxy):
     """
-    Checks passed proxy.
+    Checks passed proxy. A proxy checked by the update tasks recently gets
+    the state from the database, and a proxy checked by /check recently gets
+    the cached result, 'age' is the time (in seconds) since that check.
+    Concurrent checks of the same proxy share one probe.
     """
     host, port = proxy.split(':', 1)
-    proxy_obj = Proxy(host=host, port=int(port))
-    result = proxy_obj.check()
-    return jsonify(host=host, port=port, result=result)
+    key = f"{host}:{int(port)}"
+
+    checked = _get_db_check(host, int(port)) or check_cache.get(key)
+    if checked is None:
+        checked = check_flight.do(key, lambda: _check(host, int(port)))
+    result, checked_at = checked
+
+    age = max((datetime.now() - checked_at).total_seconds(), 0.0)
+    return jsonify(host=host, port=port, result=result, age=round(age, 3))
+
+
+def _get_db_check(host, port):
+    table = Proxy.__table__
+    row = engine.execute(
+        select([table.c.is_active, table.c.last_check_at])
+        .where(table.c.host == host)
+        .where(table.c.port == port)
+    ).first()
+    if row is not None and (datetime.now() - row.last_check_at)\
+            .total_seconds() <= CHECK_MAX_AGE:
+        return row.is_active, row.last_check_at
+    return None
+
+
+def _check(host, port):
+    checked = (Proxy(host=host, port=port).check(), datetime.now())
+    check_cache.put(f"{host}:{port}", checked)
+    return checked
 
 
 @app.route('/geo/<host>')
@@ -76,8 +259,37 @@ def geo(host):
     """
     Returns geo information about the host.
     """
-    geo_info = GeoipDB.get_instance().get_info(host)
-    return jsonify(host=host, geo=geo_info)
+    geoip_db = GeoipDB.get_instance()
+    etag = geoip_db.file_version
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    geo_info = geoip_db.get_info(host)
+    response = jsonify(host=host, geo=geo_info, version=etag)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/geo', methods=['POST'])
+def geo_many():
+    """
+    Returns geo information about the list of hosts passed as JSON body
+    {"hosts": [...]}. Geo is null for the hosts that are not valid IPv4.
+    """
+    data = request.get_json(silent=True) or {}
+    hosts = data.get('hosts')
+    if not isinstance(hosts, list) or \
+            not all(isinstance(host, str) for host in hosts):
+        return jsonify(error="'hosts' must be a list of strings"), 400
+    if len(hosts) > MAX_GEO_HOSTS:
+        return jsonify(error=f"Too many hosts (max {MAX_GEO_HOSTS})"), 400
+
+    geoip_db = GeoipDB.get_instance()
+    valid_hosts = [host for host in hosts if utils.is_ip(host)]
+    geo_info_list = geoip_db.get_info_many(valid_hosts)
+    geo_by_host = dict(zip(valid_hosts, geo_info_list))
+    return jsonify(result=[
+        {'host': host, 'geo': geo_by_host.get(host)} for host in hosts
+    ], version=geoip_db.file_version)
 
 
 @app.route('/version')
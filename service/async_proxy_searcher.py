@@ -0,0 +1,115 @@
+"""
+AsyncProxySearcher implements a search for proxies on asyncio. It has the
+same interface as ProxySearcher, but all the probes run as coroutines in one
+event loop (in a background thread), so tens of thousands of probes can be in
+flight without an OS thread for each one. Candidates are checked with
+CheckPipeline: 'concurrency' is the number of port probes in flight and
+'verify_concurrency' is the number of HTTP checks in flight.
+
+Use example:
+
+    proxy_searcher = AsyncProxySearcher(concurrency=10000,
+                                        verify_concurrency=500)
+    for proxy in proxy_searcher.search(count=10):
+        ...
+
+Instead of random addresses it can walk a scanner (see AddressPermutation)
+passed as 'scanner'.
+
+Note: every probe in flight holds a socket, so the limit of open files
+(ulimit -n) must be greater than 'concurrency'.
+"""
+
+import asyncio
+import logging
+import threading
+import traceback
+from queue import Queue
+from random import randint, choice
+
+from .proxy import Proxy, SEARCH_CONNECT_TIMEOUT, SEARCH_CHECK_TIMEOUT
+from .check_pipeline import CheckPipeline
+
+
+class SearchError(Exception):
+    """
+    Raised in the consumer of AsyncProxySearcher.search if the event loop
+    has stopped because of an error.
+    """
+
+
+class AsyncProxySearcher:
+    # Ports list to search for proxies
+    ports = (8080, 3128)
+
+    def __init__(self, concurrency, scanner=None, verify_concurrency=None):
+        self._concurrency = concurrency
+        self._verify_concurrency = verify_concurrency or \
+            max(1, concurrency // 10)
+        self._scanner = scanner
+
+    def search(self, count=None):
+        """
+        A generator that yields found proxies. 'count' is the number of proxies
+        to find. If 'count' is None, the generator is infinite.
+        """
+        # Queue to fill proxies by the event loop
+        queue = Queue()
+
+        # Stop event for the event loop
+        stop_event = threading.Event()
+
+        # Thread that runs the event loop
+        thread = threading.Thread(target=self._run_loop,
+                                  args=(queue, stop_event), daemon=True)
+        thread.start()
+
+        try:
+            found = 0
+            while count is None or found < count:
+                # Yield proxies that the probes put into the queue
+                proxy = queue.get(block=True)
+                if isinstance(proxy, SearchError):
+                    raise proxy
+                yield proxy
+                found += 1
+
+        finally:
+            # Stop the probes on exhaustion, break or error of the consumer
+            # and wait until the event loop is stopped
+            stop_event.set()
+            thread.join()
+
+            # Keep the position of the scan for the next search
+            if self._scanner is not None:
+                self._scanner.save()
+
+    def _run_loop(self, queue, stop_event):
+        try:
+            asyncio.run(self._search(queue, stop_event))
+        except Exception:
+            logging.error(traceback.format_exc())
+            queue.put(SearchError("Event loop of AsyncProxySearcher failed"))
+
+    async def _search(self, queue, stop_event):
+        def on_result(proxy, success, latency):
+            if success:
+                proxy.add_latency(latency)
+                queue.put(proxy)
+
+        pipeline = CheckPipeline(self._concurrency, self._verify_concurrency,
+                                 port_timeout=SEARCH_CONNECT_TIMEOUT,
+                                 verify_timeout=SEARCH_CHECK_TIMEOUT)
+        await pipeline.run(self._candidates(stop_event), on_result)
+
+    def _candidates(self, stop_event):
+        while not stop_event.is_set():
+            yield self._get_random_proxy()
+
+    def _get_random_proxy(self):
+        if self._scanner is not None:
+            host, port = next(self._scanner)
+            return Proxy(host=host, port=port)
+        host = ".".join(str(randint(0, 255)) for _ in range(4))
+        port = choice(self.ports)
+        return Proxy(host=host, port=port)
@@ -0,0 +1,122 @@
+"""
+Compact binary format of the proxy list (/list?format=bin). All numbers are
+big-endian. The header (20 bytes):
+
+    magic           4 bytes     b'PXL1'
+    record_size     uint16      size of a record (12)
+    reserved        uint16      0
+    version         uint64      data version of the list (see /changes)
+    count           uint32      the number of records
+
+Then 'count' fixed-width records:
+
+    ip              4 bytes     IPv4 address (0.0.0.0 if the host is not
+                                IPv4)
+    port            uint16
+    score           uint16      score * 65535
+    country         2 bytes     country code, zero padded
+    latency         uint16      latency in milliseconds, 65535 if unknown
+
+Example:
+
+    data = requests.get(f'{url}/list?format=bin').content
+    header, records = decode(data)
+    for record in records:
+        print(record.host, record.port, record.score, record.latency)
+"""
+
+import struct
+from collections import namedtuple
+
+from . import utils
+
+
+MAGIC = b'PXL1'
+
+HEADER = struct.Struct('>4sHHQI')
+RECORD = struct.Struct('>4sHH2sH')
+
+# Score is quantized to uint16
+SCORE_SCALE = 65535
+
+# Latency (in milliseconds) of the records with unknown latency
+NO_LATENCY = 65535
+
+
+Header = namedtuple('Header', ('version', 'count'))
+Record = namedtuple('Record', ('host', 'port', 'score', 'country',
+                               'latency'))
+
+
+def pack_header(version, count):
+    """
+    Returns the header for 'count' records of the data version.
+    """
+    return HEADER.pack(MAGIC, RECORD.size, 0, version, count)
+
+
+def pack_record(record):
+    """
+    Returns the bytes of the record (ProxyRecord or Proxy).
+    """
+    if utils.is_ip(record.host):
+        ip = utils.ip_to_bytes(record.host)
+    else:
+        ip = bytes(4)
+    try:
+        country = utils.str_to_bytes(record.country or '', 2)
+    except AssertionError:
+        country = bytes(2)
+    score = round(min(max(record.score, 0.0), 1.0) * SCORE_SCALE)
+    if record.latency is None:
+        latency = NO_LATENCY
+    else:
+        latency = min(round(record.latency * 1000), NO_LATENCY - 1)
+    return RECORD.pack(ip, record.port, score, country, latency)
+
+
+def pack_records(records):
+    """
+    Returns the bytes of the records without the header.
+    """
+    return b''.join(map(pack_record, records))
+
+
+def pack(version, records):
+    """
+    Returns the header and the records packed.
+    """
+    records = list(records)
+    return pack_header(version, len(records)) + pack_records(records)
+
+
+def decode(data):
+    """
+    Parses the bytes from 'pack'. Returns the Header and the iterator of
+    Record. The records are unpacked lazily from a memoryview, the data is
+    not copied. Raises ValueError if the data is not valid.
+    """
+    data = memoryview(data)
+    if len(data) < HEADER.size:
+        raise ValueError("Data is too short")
+    magic, record_size, _, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"Unknown magic: {magic!r}")
+    if record_size != RECORD.size:
+        raise ValueError(f"Unknown record size: {record_size}")
+    end = HEADER.size + count * record_size
+    if len(data) < end:
+        raise ValueError("Data is too short")
+    records = map(_decode_record, RECORD.iter_unpack(data[HEADER.size:end]))
+    return Header(version, count), records
+
+
+def _decode_record(values):
+    ip, port, score, country, latency = values
+    return Record(
+        host=utils.ip_from_bytes(ip),
+        port=port,
+        score=score / SCORE_SCALE,
+        country=utils.str_from_bytes(country),
+        latency=None if latency == NO_LATENCY else latency / 1000,
+    )
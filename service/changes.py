@@ -0,0 +1,83 @@
+"""
+Incremental feed of the list of active proxies. The writes of proxies add
+the changed rows to the change log with their data version (see
+log_changes), so a client that has the list of some version gets only the
+proxies added, changed or removed since it. If the log does not have all
+the changes (they are older than CHANGE_LOG_RETENTION) or the version is
+unknown, the feed is the full list.
+
+Example:
+
+    changes = get_changes(engine, since=120)
+    if changes.full:
+        proxies = {}
+    for record in changes.upserted:
+        proxies[record.host] = record
+    for host, port in changes.removed:
+        proxies.pop(host, None)
+    since = changes.version
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import select, exists, and_
+
+from .proxy import Proxy, engine, proxy_change_table, get_data_version, \
+                   get_pruned_version
+from .snapshot import ProxyRecord, RECORD_FIELDS
+
+
+Changes = namedtuple('Changes', ('version', 'full', 'upserted', 'removed'))
+
+
+def get_changes(engine=engine, since=None):
+    """
+    Returns Changes since the data version 'since': 'upserted' are
+    ProxyRecord of the active proxies added or changed, 'removed' are
+    (host, port) of the proxies that are not active anymore. If 'full' is
+    True, 'upserted' is the whole list and the client must replace its one.
+    All of it is read in one transaction, so it is consistent with
+    'version'.
+    """
+    # pysqlite does not begin a transaction before SELECT, so the reads see
+    # one snapshot of the database only in an explicit one
+    with engine.connect() as conn:
+        conn.execute("BEGIN")
+        try:
+            return _read_changes(conn, since)
+        finally:
+            conn.execute("ROLLBACK")
+
+
+def _read_changes(conn, since):
+    table = Proxy.__table__
+    change_table = proxy_change_table
+    fields = [table.c[field] for field in RECORD_FIELDS]
+
+    version = get_data_version(conn)
+    if since is not None and since == version:
+        return Changes(version, False, [], [])
+
+    if since is None or since > version or \
+            since < get_pruned_version(conn):
+        rows = conn.execute(
+            select(fields).where(table.c.is_active)
+        ).fetchall()
+        return Changes(version, True, [ProxyRecord(*row) for row in rows], [])
+
+    changed_hosts = select([change_table.c.host]) \
+        .where(change_table.c.version > since)
+    upserted = conn.execute(
+        select(fields)
+        .where(table.c.is_active)
+        .where(table.c.host.in_(changed_hosts))
+    ).fetchall()
+    removed = conn.execute(
+        select([change_table.c.host, change_table.c.port])
+        .distinct()
+        .where(change_table.c.version > since)
+        .where(~exists().where(and_(table.c.host == change_table.c.host,
+                                    table.c.is_active)))
+    ).fetchall()
+    return Changes(version, False, [ProxyRecord(*row) for row in upserted],
+                   [tuple(row) for row in removed])
@@ -0,0 +1,286 @@
+"""
+CheckPipeline checks proxies in two stages on asyncio. The first stage only
+opens the port of the proxy, it is cheap and runs with high concurrency. The
+proxies with open ports go through a bounded queue to the second stage that
+requests TRY_URL through them with smaller concurrency and a longer timeout.
+If the second stage falls behind, the queue gets full and the first stage
+waits, so the open sockets do not pile up.
+
+Most of candidates fail at the first stage, so slow HTTP requests do not
+hold the slots of quick port probes. With 'adaptive=True' the timeouts of
+each proxy are derived from its latency history (see Proxy.get_timeouts)
+instead of 'port_timeout' and 'verify_timeout'.
+
+With ConcurrencyController the limit of the first stage is not fixed, it is
+adjusted at runtime by the measured timeouts, success rate and the usage of
+file descriptors.
+
+Example:
+
+    pipeline = CheckPipeline(port_concurrency=1000, verify_concurrency=100)
+    result = pipeline.check_many(proxy_list)  # [True, False, ...]
+"""
+
+import asyncio
+import logging
+import traceback
+from collections import Counter
+
+from . import probe
+from .utils import get_fd_usage
+from .proxy import TRY_URL, TRY_CONTENT, CHECK_TIMEOUT, CONNECT_TIMEOUT, \
+                   Latency
+
+
+class Limiter:
+    """
+    Semaphore for coroutines with the limit that can be changed at runtime.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._active = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def active(self):
+        return self._active
+
+    async def set_limit(self, limit):
+        """
+        Changes the limit and wakes up waiting coroutines if it grows.
+        """
+        async with self._condition:
+            self._limit = limit
+            self._condition.notify_all()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._active < self._limit
+            )
+            self._active += 1
+
+    async def release(self):
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+
+class ConcurrencyController:
+    """
+    Adjusts the limit of port checks in flight of CheckPipeline every
+    'interval' seconds within [min_limit, max_limit], the same way as TCP
+    congestion control does: it grows slowly while the stage is saturated
+    and the checks go well, and drops fast on signs of overload - too many
+    connect timeouts, a sudden fall of the success rate or file descriptors
+    running out.
+    """
+
+    def __init__(self, min_limit, max_limit, interval=5.0,
+                 max_timeout_rate=0.5, max_fd_usage=0.8):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._interval = interval
+        self._max_timeout_rate = max_timeout_rate
+        self._max_fd_usage = max_fd_usage
+        self._success_rate = None
+
+    async def run(self, limiter, stats):
+        """
+        Adjusts the limit of 'limiter' by the counters in 'stats' (see
+        CheckPipeline.stats) until cancelled.
+        """
+        prev = Counter(stats)
+        while True:
+            await asyncio.sleep(self._interval)
+            delta = Counter(stats)
+            delta.subtract(prev)
+            prev = Counter(stats)
+            limit = self.get_limit(limiter.limit, delta, get_fd_usage())
+            if limit != limiter.limit:
+                logging.info(f"Port check limit {limiter.limit} -> {limit}")
+                await limiter.set_limit(limit)
+
+    def get_limit(self, limit, delta, fd_usage):
+        """
+        Returns the new limit by the current one, the counters of the last
+        interval and the ratio of open file descriptors to the limit.
+        """
+        checks = delta['checks']
+        timeout_rate = delta['timeouts'] / checks if checks else 0.0
+        success_rate = delta['successes'] / checks if checks else None
+
+        if fd_usage > self._max_fd_usage:
+            limit //= 2
+        elif timeout_rate > self._max_timeout_rate:
+            limit = limit * 3 // 4
+        elif success_rate is not None and self._success_rate and \
+                success_rate < self._success_rate / 2:
+            limit = limit * 3 // 4
+        elif delta['waits']:
+            limit += max(1, limit // 10)
+
+        if success_rate is not None:
+            # Moving average of the success rate
+            self._success_rate = success_rate if self._success_rate is None \
+                else 0.8 * self._success_rate + 0.2 * success_rate
+
+        return min(max(limit, self.min_limit), self.max_limit)
+
+
+class CheckPipeline:
+    def __init__(self, port_concurrency, verify_concurrency,
+                 port_timeout=CONNECT_TIMEOUT, verify_timeout=CHECK_TIMEOUT,
+                 queue_size=None, url=TRY_URL, content=TRY_CONTENT,
+                 adaptive=False):
+        self._port_concurrency = port_concurrency
+        self._verify_concurrency = verify_concurrency
+        self._port_timeout = port_timeout
+        self._verify_timeout = verify_timeout
+        self._queue_size = queue_size or 2 * verify_concurrency
+        self._url = url
+        self._content = content.encode()
+        self._adaptive = adaptive
+
+        # Counters of checks, successes, port timeouts and waits for a slot
+        # in the port stage
+        self.stats = Counter()
+
+    def check_many(self, proxy_list):
+        """
+        Checks proxies from 'proxy_list' and returns the list of results
+        in the same order.
+        """
+        result = {}
+
+        def on_result(proxy, success, latency):
+            result[id(proxy)] = success
+
+        asyncio.run(self.run(proxy_list, on_result))
+        return [result[id(proxy)] for proxy in proxy_list]
+
+    async def run(self, proxies, on_result, controller=None):
+        """
+        Checks proxies from the iterable or async iterable 'proxies' (it can
+        be infinite) and calls on_result(proxy, success, latency) for each
+        one as soon as it is checked (latency is Latency for the working
+        proxies and None for the rest). It returns when all the proxies are
+        checked. If 'controller' (ConcurrencyController) is given, it
+        adjusts the limit of the port stage.
+        """
+        # Limiter for the port stage is created inside the running loop
+        port_limiter = Limiter(self._port_concurrency)
+        if controller is not None:
+            control_task = asyncio.ensure_future(
+                controller.run(port_limiter, self.stats)
+            )
+
+        # Queue between the stages with open sockets
+        queue = asyncio.Queue(self._queue_size)
+
+        def on_check(proxy, success, latency=None):
+            self.stats['checks'] += 1
+            if success:
+                self.stats['successes'] += 1
+            _call(on_result, proxy, success, latency)
+
+        # Workers of the verify stage
+        workers = [
+            asyncio.ensure_future(self._verify_worker(queue, on_check))
+            for _ in range(self._verify_concurrency)
+        ]
+
+        # Tasks of the port stage in flight
+        port_tasks = set()
+
+        async def start(proxy):
+            if port_limiter.active >= port_limiter.limit:
+                self.stats['waits'] += 1
+            await port_limiter.acquire()
+            task = asyncio.ensure_future(
+                self._port_stage(proxy, queue, port_limiter, on_check)
+            )
+            port_tasks.add(task)
+            task.add_done_callback(port_tasks.discard)
+
+        try:
+            if hasattr(proxies, '__aiter__'):
+                async for proxy in proxies:
+                    await start(proxy)
+            else:
+                for proxy in proxies:
+                    await start(proxy)
+
+            # Wait for the port stage, then stop the workers
+            if port_tasks:
+                await asyncio.wait(port_tasks)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+        finally:
+            if controller is not None:
+                control_task.cancel()
+
+    async def _port_stage(self, proxy, queue, port_limiter, on_result):
+        loop = asyncio.get_running_loop()
+        try:
+            started_at = loop.time()
+            sock = await self._open_port(proxy)
+            connect_time = loop.time() - started_at
+            if sock is None:
+                if connect_time >= self._get_timeouts(proxy)[0]:
+                    self.stats['timeouts'] += 1
+                on_result(proxy, False)
+            else:
+                # Wait here if the verify stage is behind
+                await queue.put((proxy, sock, connect_time))
+        except Exception:
+            logging.error(traceback.format_exc())
+            on_result(proxy, False)
+        finally:
+            await port_limiter.release()
+
+    async def _verify_worker(self, queue, on_result):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            proxy, sock, connect_time = item
+            timings = {}
+            try:
+                success = await self._verify(proxy, sock, timings)
+            except Exception:
+                logging.error(traceback.format_exc())
+                success = False
+            if success:
+                latency = Latency(connect_time, timings.get('ttfb', 0.0))
+                on_result(proxy, True, latency)
+            else:
+                on_result(proxy, False)
+
+    async def _open_port(self, proxy):
+        return await probe.open_port(proxy.host, proxy.port,
+                                     self._get_timeouts(proxy)[0])
+
+    async def _verify(self, proxy, sock, timings):
+        return await probe.try_proxy(sock, self._url,
+                                     self._get_timeouts(proxy)[1],
+                                     self._content, timings)
+
+    def _get_timeouts(self, proxy):
+        if self._adaptive:
+            return proxy.get_timeouts()
+        return self._port_timeout, self._verify_timeout
+
+
+def _call(on_result, proxy, success, latency):
+    try:
+        on_result(proxy, success, latency)
+    except Exception:
+        logging.error(traceback.format_exc())
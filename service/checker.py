@@ -0,0 +1,194 @@
+"""
+ProxyChecker continuously checks the proxies in the database. It streams
+the due proxies (active and inactive, in order of next_check_at, see
+Proxy.schedule) into one CheckPipeline and writes the results with bulk
+UPDATEs (Proxy.update_many) as they come, so the checks go at a steady rate
+instead of bursts. The number of port checks in flight is adjusted by
+ConcurrencyController between 'min_concurrency' and 'max_concurrency',
+and the timeouts of each proxy follow its latency history.
+
+All the work with the database goes in one background thread, so the event
+loop is never blocked by SQLite.
+
+Example:
+
+    checker = ProxyChecker(min_concurrency=10, max_concurrency=1000,
+                           verify_concurrency=100)
+    checker.run()  # infinite
+"""
+
+import asyncio
+import logging
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.orm import sessionmaker
+
+from .proxy import Proxy, engine
+from .check_pipeline import CheckPipeline, ConcurrencyController
+
+
+class ProxyChecker:
+    # The number of due proxies to fetch from the database at once
+    fetch_size = 1000
+
+    # How often (in seconds) to write the results
+    flush_interval = 1.0
+
+    # Maximal time (in seconds) to wait for due proxies, so new proxies
+    # are not missed
+    idle_timeout = 60.0
+
+    def __init__(self, min_concurrency, max_concurrency, verify_concurrency,
+                 engine=engine):
+        self._min_concurrency = min_concurrency
+        self._max_concurrency = max_concurrency
+        self._verify_concurrency = verify_concurrency
+        self._engine = engine
+        self._session = sessionmaker(bind=engine)()
+        self._executor = ThreadPoolExecutor(1)
+
+        # Hosts of the proxies fetched and not written yet
+        self._pending = set()
+
+        # Checked proxies to write
+        self._results = []
+
+    def run(self, stop_event=None):
+        """
+        Checks the proxies until 'stop_event' (threading.Event) is set, or
+        infinitely if it is None.
+        """
+        asyncio.run(self.run_async(stop_event or threading.Event()))
+
+    async def run_async(self, stop_event):
+        pipeline = CheckPipeline(self._min_concurrency,
+                                 self._verify_concurrency, adaptive=True)
+        controller = ConcurrencyController(self._min_concurrency,
+                                           self._max_concurrency)
+        done_event = asyncio.Event()
+        flush_task = asyncio.ensure_future(self._flush_loop(done_event))
+        try:
+            await pipeline.run(self._feed(stop_event), self._on_result,
+                               controller)
+        finally:
+            done_event.set()
+            await flush_task
+
+    async def _feed(self, stop_event):
+        loop = asyncio.get_running_loop()
+        while not stop_event.is_set():
+            try:
+                proxy_list, next_due = await loop.run_in_executor(
+                    self._executor, self._fetch_due, frozenset(self._pending),
+                )
+            except Exception:
+                logging.error(traceback.format_exc())
+                proxy_list, next_due = [], None
+            for proxy in proxy_list:
+                self._pending.add(proxy.host)
+                yield proxy
+            if not proxy_list:
+                await self._sleep(self._get_timeout(next_due), stop_event)
+
+    def _fetch_due(self, pending):
+        # Runs in the executor thread
+        try:
+            now = datetime.now()
+            proxy_list = [
+                proxy
+                for is_active in (True, False)
+                for proxy in Proxy.list_due(
+                    self._session, is_active, now,
+                    self.fetch_size + len(pending),
+                )
+                if proxy.host not in pending
+            ]
+            proxy_list.sort(key=lambda e: e.next_check_at)
+            next_due = min(
+                filter(None, (Proxy.get_next_due(self._session, is_active)
+                              for is_active in (True, False))),
+                default=None,
+            )
+            # The proxies are changed in the event loop, detached from the
+            # session
+            self._session.expunge_all()
+            return proxy_list[:self.fetch_size], next_due
+        finally:
+            self._session.rollback()
+
+    def _get_timeout(self, next_due):
+        if next_due is None:
+            return self.idle_timeout
+        timeout = (next_due - datetime.now()).total_seconds()
+        return min(max(timeout, self.flush_interval), self.idle_timeout)
+
+    async def _sleep(self, timeout, stop_event):
+        # Wake up on stop_event every flush_interval
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not stop_event.is_set() and loop.time() < deadline:
+            await asyncio.sleep(
+                min(self.flush_interval, deadline - loop.time())
+            )
+
+    def _on_result(self, proxy, success, latency):
+        # Stamp the time of the write, so readers that follow last_check_at
+        # (see ProxySnapshotManager) see the change
+        now = datetime.now()
+        apply_result(proxy, success, now, latency)
+        proxy.last_check_at = now
+        proxy.schedule()
+        self._results.append(proxy)
+
+    async def _flush_loop(self, done_event):
+        while not done_event.is_set():
+            try:
+                await asyncio.wait_for(done_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._flush()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+    async def _flush(self):
+        if not self._results:
+            return
+        proxy_list, self._results = self._results, []
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self._executor, Proxy.update_many, proxy_list, self._engine,
+            )
+        except Exception:
+            # Try again next time
+            self._results.extend(proxy_list)
+            raise
+        self._pending.difference_update(proxy.host for proxy in proxy_list)
+        logging.info(f"{len(proxy_list)} proxies updated")
+
+
+def apply_result(proxy, success, now, latency=None):
+    """
+    Changes the proxy according to the result of the check: the score goes
+    up or down, a failed active proxy becomes inactive and a working
+    inactive proxy becomes active. The latency of a working proxy is added
+    to its history.
+    """
+    if success:
+        logging.info(f"Successfully checked proxy {proxy}")
+        if not proxy.is_active:
+            proxy.is_active = True
+            proxy.inactive_since = None
+        proxy.score_up()
+        if latency is not None:
+            proxy.add_latency(latency)
+    else:
+        logging.info(f"Failed proxy {proxy}")
+        if proxy.is_active:
+            proxy.is_active = False
+            proxy.inactive_since = now
+        proxy.score_down()
@@ -10,102 +10,440 @@ Before the use it is necessary to prepare binary database. To do it:
         https://db-ip.com/db/download/ip-to-city-lite.
         The direct link is similar to
         https://download.db-ip.com/free/dbip-city-lite-2020-12.csv.gz.
-    3. Extract CSV from from the archive.
-    4. Run prepare_geoip_db with the path to the excracted archive.
+    3. Run prepare_geoip_db with the path to the archive (.csv.gz) or to
+        the extracted CSV.
 
 Use example:
 
     geoip_db = GeoipDB.get_instance()
     geo_info = geoip_db.get_info('178.153.16.203')
+
+The singleton follows the file: get_instance checks every
+GEOIP_RELOAD_INTERVAL seconds if the file at GEOIP_DB_PATH has been replaced
+(for example, by prepare_geoip_db) and loads the new one in a background
+thread. Until the new database is loaded the old one keeps serving, then the
+singleton is swapped. The old mapping is closed when the last lookup that
+uses it finishes (when it is garbage collected). GeoipDB.reload does the
+same on demand.
+
+There are two binary formats, GeoipDB detects the format of the file itself:
+
+    v1 - a sequence of 148-byte blocks, one per range (see _pack_block).
+    v2 - (written by prepare_geoip_db) a header (see HEADER_V2) followed by
+        dense little-endian arrays: range ends (uint32), region and city
+        indices (uint32), country indices (uint16), and then three string
+        tables (country, region, city). Each table is an array of (count + 1)
+        uint32 offsets and a blob of UTF-8 strings. Repeated strings are
+        stored once, so the file is many times smaller than v1. Continent and
+        coordinates are not stored as GeoipDB does not return them.
 """
 
 import os
-import re
+import zlib
 import csv
+import sys
+import gzip
+import mmap
+import socket
+import struct
+import logging
+import tempfile
+import threading
+import traceback
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from time import monotonic
 
 from . import utils
 
 
 GEOIP_DB_PATH = os.environ.get('GEOIP_DB_PATH', 'tmp/geoip.db')
 
-IP_V4_PATTERN = re.compile(r'^\d{,3}\.\d{,3}\.\d{,3}\.\d{,3}$')
+# How often (in seconds) to check if the database file has been replaced
+GEOIP_RELOAD_INTERVAL = float(os.environ.get('GEOIP_RELOAD_INTERVAL', '10.0'))
+
+# Size of a block in the format v1
+BLOCK_SIZE_V1 = 148
+
+# Magic number in the beginning of the formats v2 and higher
+MAGIC = b'PFGEODB\x00'
+
+# The number of CSV rows packed at once in prepare_geoip_db
+PREPARE_BATCH_SIZE = 100000
+
+# Header of the format v2: magic, version, the number of ranges, the number
+# of countries, regions and cities, reserved
+HEADER_V2 = struct.Struct('<8sIIIIII')
 
 
 class GeoipDB:
     """
     GeoipDB implements a singleton that gives geo information about IP.
-    It keeps opened file object and seeks for the necessary records using
-    binary search algorithm.
+    The database file is memory-mapped. The ends of the ranges are kept as a
+    sorted array of integers (loaded on open for v1 and mapped as is for v2),
+    so a lookup is a bisection in that array and a read of one record from
+    the mapping. There is no shared file position, so lookups are safe in any
+    thread and make no syscalls.
     """
 
     _instance = None
+    _instance_lock = threading.Lock()
+    _checked_at = 0.0
+    _reload_thread = None
 
-    def __init__(self, path, block_size):
-        self._file = open(path, 'rb')
-        self._block_size = block_size
-        self._size = os.path.getsize(path) // self._block_size
+    def __init__(self, path, block_size=BLOCK_SIZE_V1):
+        with open(path, 'rb') as f:
+            self.file_id = _get_file_id(os.fstat(f.fileno()))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = []
+        if self._mmap[:len(MAGIC)] == MAGIC:
+            self._open_v2()
+        else:
+            self._open_v1(block_size)
 
     def __del__(self):
-        self._file.close()
+        # Views must be released before the mapping is closed
+        for view in getattr(self, '_views', ()):
+            view.release()
+        if hasattr(self, '_mmap'):
+            self._mmap.close()
 
     @classmethod
     def get_instance(cls):
         """
         Gets the instance or creates a new one as singleton.
         """
-        if cls._instance is None:
-            cls._instance = cls(GEOIP_DB_PATH, block_size=148)
-        return cls._instance
+        instance = cls._instance
+        if instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(GEOIP_DB_PATH)
+                    cls._checked_at = monotonic()
+                return cls._instance
+
+        if monotonic() - cls._checked_at > GEOIP_RELOAD_INTERVAL:
+            cls._check_file()
+        return instance
+
+    @classmethod
+    def reload(cls, wait=True):
+        """
+        Loads the database from GEOIP_DB_PATH in a background thread and
+        swaps the singleton when it is loaded. If 'wait' is true, it returns
+        after the swap.
+        """
+        with cls._instance_lock:
+            if cls._reload_thread is None or \
+                    not cls._reload_thread.is_alive():
+                cls._reload_thread = threading.Thread(target=cls._reload,
+                                                      daemon=True)
+                cls._reload_thread.start()
+            thread = cls._reload_thread
+        if wait:
+            thread.join()
+
+    @classmethod
+    def _check_file(cls):
+        cls._checked_at = monotonic()
+        try:
+            file_id = _get_file_id(os.stat(GEOIP_DB_PATH))
+        except OSError:
+            # The file is being replaced or removed, keep the current one
+            return
+        if file_id != cls._instance.file_id:
+            cls.reload(wait=False)
+
+    @classmethod
+    def _reload(cls):
+        try:
+            instance = cls(GEOIP_DB_PATH)
+        except Exception:
+            logging.error(traceback.format_exc())
+            return
+        # The old instance stays alive while it is used by lookups
+        cls._instance = instance
+        logging.info(f"GeoIP DB reloaded from {GEOIP_DB_PATH}")
+
+    @property
+    def version(self):
+        """
+        Version of the binary format.
+        """
+        return self._version
+
+    @property
+    def file_version(self):
+        """
+        Version of the data: it changes when the file is replaced.
+        """
+        return '%x' % zlib.crc32(repr(self.file_id).encode())
 
     def get_info(self, ip):
         """
         Gets geo info about ip.
         """
-        ip_bytes = utils.ip_to_bytes(ip)
-        idx = self._find_idx(ip_bytes)
-        block = self._get_block(idx)
-        row = _unpack_block(block)
+        return self._get_info_by_idx(self._find_idx(ip))
+
+    def get_info_many(self, ips):
+        """
+        Gets geo info about each ip in the iterable 'ips'. The result is a
+        list in the same order. The records shared by several ips are decoded
+        once.
+        """
+        idx_list = list(map(self._find_idx, ips))
+        info_by_idx = {
+            idx: self._get_info_by_idx(idx) for idx in set(idx_list)
+        }
+        return [info_by_idx[idx] for idx in idx_list]
+
+    def _open_v1(self, block_size):
+        self._version = 1
+        self._block_size = block_size
+        self._size = len(self._mmap) // self._block_size
+        self._keys = self._load_keys_v1()
+
+    def _open_v2(self):
+        _, version, size, countries_num, regions_num, cities_num, _ = \
+            HEADER_V2.unpack_from(self._mmap)
+        if version != 2:
+            raise ValueError(f"Unsupported version of GeoIP DB: {version}")
+        self._version = version
+        self._size = size
+
+        offset = HEADER_V2.size
+        self._keys, offset = self._map_array('I', offset, size)
+        self._region_idx, offset = self._map_array('I', offset, size)
+        self._city_idx, offset = self._map_array('I', offset, size)
+        self._country_idx, offset = self._map_array('H', offset, size)
+        offset = _align(offset)
+        self._countries, offset = self._map_strings(offset, countries_num)
+        self._regions, offset = self._map_strings(offset, regions_num)
+        self._cities, offset = self._map_strings(offset, cities_num)
+
+    def _map_array(self, typecode, offset, size):
+        end = offset + array(typecode).itemsize * size
+        if sys.byteorder == 'little':
+            # Zero-copy view of the mapping
+            view = memoryview(self._mmap)[offset:end].cast(typecode)
+            self._views.append(view)
+        else:
+            view = array(typecode)
+            view.frombytes(self._mmap[offset:end])
+            view.byteswap()
+        return view, end
+
+    def _map_strings(self, offset, size):
+        offsets, offset = self._map_array('I', offset, size + 1)
+        end = offset + offsets[size]
+        blob = memoryview(self._mmap)[offset:end]
+        self._views.append(blob)
+        return (offsets, blob), _align(end)
+
+    def _get_info_by_idx(self, idx):
+        if idx >= self._size:
+            return {'country': '', 'region': '', 'city': ''}
+        if self._version == 1:
+            row = _unpack_block(self._get_block(idx))
+            return {
+                'country': row[3],
+                'region': row[4],
+                'city': row[5],
+            }
         return {
-            'country': row[3],
-            'region': row[4],
-            'city': row[5],
+            'country': _get_string(self._countries, self._country_idx[idx]),
+            'region': _get_string(self._regions, self._region_idx[idx]),
+            'city': _get_string(self._cities, self._city_idx[idx]),
         }
 
     def _get_block(self, idx):
-        self._file.seek(idx * self._block_size)
-        return self._file.read(self._block_size)
-
-    def _find_idx(self, ip_bytes):
-        idx = 0
-        size = self._size
-        while size > 0:
-            block = self._get_block(idx + size // 2)
-            if ip_bytes > block[4:8]:
-                idx += size // 2 + 1
-                size = size // 2 + size % 2 + 1
-            else:
-                size = size // 2
-        return idx
-
-
-def prepare_geoip_db(csv_path):
+        offset = idx * self._block_size
+        return self._mmap[offset:offset + self._block_size]
+
+    def _find_idx(self, ip):
+        # Index of the first range with the end not less than ip
+        key = int.from_bytes(utils.ip_to_bytes(ip), 'big')
+        return bisect_left(self._keys, key)
+
+    def _load_keys_v1(self):
+        # The ends of the ranges are big-endian 4 bytes at offset 4 of each
+        # block, they are gathered with strided slices of the mapping
+        size = self._size * self._block_size
+        keys_bytes = bytearray(4 * self._size)
+        for i in range(4):
+            keys_bytes[i::4] = self._mmap[4 + i:size:self._block_size]
+        keys = array('I')
+        keys.frombytes(bytes(keys_bytes))
+        if sys.byteorder == 'little':
+            keys.byteswap()
+        return keys
+
+
+class GeoipDBWriter:
     """
-    Transforms CSV geo database to binary format that can be successfully
-    interpreted by GeoipDB.
+    Collects ranges (that must be added in ascending order) and writes them
+    in the format v2.
+    """
+
+    def __init__(self):
+        self._keys = array('I')
+        self._country_idx = array('H')
+        self._region_idx = array('I')
+        self._city_idx = array('I')
+        self._countries = {}
+        self._regions = {}
+        self._cities = {}
+
+    def add(self, ip_to, country, region, city):
+        """
+        Adds the range with the end ip_to.
+        """
+        self.add_many([(None, ip_to, None, country, region, city)])
+
+    def add_many(self, rows):
+        """
+        Adds a batch of CSV rows (ip_from, ip_to, continent, country, region,
+        city, ...).
+        """
+        countries, regions, cities = \
+            self._countries, self._regions, self._cities
+        self._keys.extend([_ip_to_int(row[1]) for row in rows])
+        self._country_idx.extend([
+            _intern(countries, row[3]) for row in rows
+        ])
+        self._region_idx.extend([
+            _intern(regions, row[4]) for row in rows
+        ])
+        self._city_idx.extend([
+            _intern(cities, row[5]) for row in rows
+        ])
+
+    def write(self, f):
+        """
+        Writes the database into the binary file object f.
+        """
+        if len(self._countries) > 0xFFFF:
+            raise ValueError("Too many countries for the format v2")
+
+        f.write(HEADER_V2.pack(
+            MAGIC, 2, len(self._keys), len(self._countries),
+            len(self._regions), len(self._cities), 0,
+        ))
+        offset = HEADER_V2.size
+        for values in (self._keys, self._region_idx, self._city_idx,
+                       self._country_idx):
+            offset += _write_array(f, values)
+        offset += _write_padding(f, offset)
+        for table in (self._countries, self._regions, self._cities):
+            offset += _write_strings(f, table)
+            offset += _write_padding(f, offset)
+
+
+def prepare_geoip_db(csv_path, db_path=None, progress=None):
+    """
+    Transforms CSV geo database (plain or gzipped, it is read as a stream) to
+    binary format (v2) that can be successfully interpreted by GeoipDB. The
+    database is written to a temporary file and renamed to 'db_path'
+    (GEOIP_DB_PATH by default) atomically, so the readers never see a broken
+    file. 'progress' is called with the number of rows and rows per second
+    after each batch (it logs by default).
 
     To run this function use manage.py:
 
-        python manage.py prepare_geoip_db --path /path/to/csv/db.csv
+        python manage.py prepare_geoip_db --path /path/to/csv/db.csv.gz
     """
-    with open(GEOIP_DB_PATH, 'wb') as geoip_db_file:
-        with open(csv_path) as csv_file:
-            for row in csv.reader(csv_file):
-                # Use IPv4 only
-                if IP_V4_PATTERN.match(row[0]):
-                    row[6] = float(row[6])
-                    row[7] = float(row[7])
-                    block = _pack_block(*row)
-                    geoip_db_file.write(block)
+    db_path = db_path or GEOIP_DB_PATH
+    progress = progress or _log_progress
+    writer = GeoipDBWriter()
+    started_at = monotonic()
+    rows_num = 0
+
+    with _open_csv(csv_path) as csv_file:
+        reader = csv.reader(csv_file)
+        while True:
+            batch = list(islice(reader, PREPARE_BATCH_SIZE))
+            if not batch:
+                break
+            rows_num += len(batch)
+
+            # Use IPv4 only (IPv6 addresses contain colons)
+            writer.add_many([row for row in batch if ':' not in row[0]])
+            progress(rows_num, rows_num / (monotonic() - started_at))
+
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    fd, tmp_path = tempfile.mkstemp(dir=db_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as geoip_db_file:
+            writer.write(geoip_db_file)
+            geoip_db_file.flush()
+            os.fsync(geoip_db_file.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, db_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _open_csv(csv_path):
+    if csv_path.endswith('.gz'):
+        return gzip.open(csv_path, 'rt', newline='', encoding='utf-8')
+    return open(csv_path, newline='', encoding='utf-8')
+
+
+def _log_progress(rows_num, rows_per_sec):
+    logging.info(f"Processed {rows_num} rows ({rows_per_sec:.0f} rows/sec)")
+
+
+def _get_file_id(stat):
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _ip_to_int(ip):
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+def _intern(table, s):
+    # Index of the string in the table, the string is added if it is new
+    idx = table.get(s)
+    if idx is None:
+        idx = table[s] = len(table)
+    return idx
+
+
+def _write_array(f, values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    data = values.tobytes()
+    f.write(data)
+    return len(data)
+
+
+def _write_strings(f, table):
+    # Dicts keep the order of insertion, so it is the order of indices
+    encoded = [s.encode() for s in table]
+    offsets = array('I', [0])
+    for b in encoded:
+        offsets.append(offsets[-1] + len(b))
+    blob = b''.join(encoded)
+    size = _write_array(f, offsets)
+    f.write(blob)
+    return size + len(blob)
+
+
+def _write_padding(f, offset):
+    padding = _align(offset) - offset
+    f.write(b'\x00' * padding)
+    return padding
+
+
+def _align(offset):
+    return (offset + 3) // 4 * 4
+
+
+def _get_string(table, idx):
+    offsets, blob = table
+    return str(blob[offsets[idx]:offsets[idx + 1]], 'utf-8')
 
 
 def _pack_block(ip_from, ip_to, continent, country, region, city,
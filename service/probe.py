@@ -0,0 +1,253 @@
+"""
+Lightweight probes for proxies that do the HTTP exchange directly on the
+socket: they send a minimal request through the proxy and read only the
+status line and a small prefix of the body. There are non-blocking versions
+for asyncio (open_port and try_proxy), so thousands of them can be in flight
+in one thread, and a blocking version (verify) for a socket connected in the
+usual way.
+
+Example:
+
+    sock = await open_port('3.80.37.204', 3128, timeout=1.0)
+    if sock is not None:
+        result = await try_proxy(sock, 'https://example.org/', 3.0)
+"""
+
+import ssl
+import socket
+import asyncio
+import logging
+from time import monotonic
+from urllib.parse import urlsplit
+
+
+# Maximal size of the response head to read from proxy
+MAX_HEAD_SIZE = 8192
+
+# Size of the body prefix to look for the expected content in
+BODY_PREFIX_SIZE = 4096
+
+# SSL context shared by all probes (creating a context is expensive)
+_ssl_context = None
+
+
+async def open_port(host, port, timeout):
+    """
+    Connects to host:port without blocking. Returns the connected socket or
+    None if the port is not open within the timeout.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    except OSError as exc:
+        # Most likely no free file descriptors, so wait for the other probes
+        # to release them instead of retrying at once
+        logging.warning(f"Cannot create socket: {exc}")
+        await asyncio.sleep(timeout)
+        return None
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, (host, port)), timeout)
+    except (OSError, asyncio.TimeoutError):
+        sock.close()
+        return None
+    return sock
+
+
+async def try_proxy(sock, url, timeout, content=b'', timings=None):
+    """
+    Requests url through the proxy connected to sock and returns True if
+    the response status is 200 and the body prefix contains 'content'. For
+    HTTPS url it uses the CONNECT method and the request goes through a TLS
+    tunnel. The socket is always closed on return. If the dict 'timings' is
+    given, the time to the first byte of the response (in seconds, since
+    the request is sent) is stored there as 'ttfb'.
+    """
+    if timings is None:
+        timings = {}
+    try:
+        return await asyncio.wait_for(_exchange(sock, url, content, timings),
+                                      timeout)
+    except (OSError, ssl.SSLError, asyncio.TimeoutError, ValueError):
+        return False
+    finally:
+        # Closing a socket that a transport has already closed is a no-op
+        sock.close()
+
+
+def verify(sock, url, timeout, content=b'', timings=None):
+    """
+    Blocking version of try_proxy for a connected blocking socket. The
+    timeout is the deadline for the whole exchange. The socket is always
+    closed on return.
+    """
+    if timings is None:
+        timings = {}
+    deadline = monotonic() + timeout
+    parts = urlsplit(url)
+    conn = sock
+    try:
+        if parts.scheme == 'https':
+            port = parts.port or 443
+            conn.sendall(_connect_request(parts.hostname, port))
+            head = _read_sync(conn, deadline)
+            if _parse_head(head) != 200:
+                return False
+
+            _set_timeout(conn, deadline)
+            conn = _get_ssl_context().wrap_socket(
+                sock, server_hostname=parts.hostname,
+            )
+            request = _get_request(_target(parts), parts.netloc)
+
+        else:
+            request = _get_request(url, parts.netloc)
+
+        conn.sendall(request)
+        timings['sent_at'] = monotonic()
+        response = _read_sync(conn, deadline, content, timings)
+        return _check_response(response, content)
+
+    except (OSError, ssl.SSLError, ValueError):
+        return False
+
+    finally:
+        conn.close()
+        sock.close()
+
+
+async def _exchange(sock, url, content, timings):
+    loop = asyncio.get_running_loop()
+    parts = urlsplit(url)
+
+    if parts.scheme == 'https':
+        port = parts.port or 443
+        await loop.sock_sendall(sock, _connect_request(parts.hostname, port))
+        head = await _read_async(lambda: loop.sock_recv(sock, 1024))
+        if _parse_head(head) != 200:
+            return False
+
+        # The transport takes the ownership of the socket from here
+        reader, writer = await asyncio.open_connection(
+            sock=sock, ssl=_get_ssl_context(),
+            server_hostname=parts.hostname,
+        )
+        try:
+            writer.write(_get_request(_target(parts), parts.netloc))
+            timings['sent_at'] = monotonic()
+            response = await _read_async(lambda: reader.read(1024), content,
+                                         timings)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+        return _check_response(response, content)
+
+    else:
+        await loop.sock_sendall(sock, _get_request(url, parts.netloc))
+        timings['sent_at'] = monotonic()
+        response = await _read_async(lambda: loop.sock_recv(sock, 1024),
+                                     content, timings)
+        return _check_response(response, content)
+
+
+async def _read_async(recv, content=None, timings=None):
+    data = b''
+    while not _is_complete(data, content):
+        chunk = await recv()
+        if not chunk:
+            break
+        if not data and timings is not None:
+            _set_ttfb(timings)
+        data += chunk
+    return data
+
+
+def _read_sync(conn, deadline, content=None, timings=None):
+    data = b''
+    while not _is_complete(data, content):
+        _set_timeout(conn, deadline)
+        chunk = conn.recv(1024)
+        if not chunk:
+            break
+        if not data and timings is not None:
+            _set_ttfb(timings)
+        data += chunk
+    return data
+
+
+def _set_ttfb(timings):
+    timings['ttfb'] = monotonic() - timings.pop('sent_at')
+
+
+def _set_timeout(conn, deadline):
+    timeout = deadline - monotonic()
+    if timeout <= 0:
+        raise socket.timeout("Proxy check timed out")
+    conn.settimeout(timeout)
+
+
+def _is_complete(data, content):
+    # Without content only the head is needed (like the response to CONNECT)
+    head, sep, body = data.partition(b'\r\n\r\n')
+    if not sep:
+        if len(head) > MAX_HEAD_SIZE:
+            raise ValueError("Too large response head")
+        return False
+    if not content or content in body:
+        return True
+    return len(body) >= BODY_PREFIX_SIZE
+
+
+def _check_response(response, content):
+    if _parse_head(response) != 200:
+        return False
+    body = response.partition(b'\r\n\r\n')[2]
+    return content in body[:BODY_PREFIX_SIZE]
+
+
+def _target(parts):
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    return target
+
+
+def _connect_request(host, port):
+    return (
+        f"CONNECT {host}:{port} HTTP/1.1\r\n"
+        f"Host: {host}:{port}\r\n"
+        f"\r\n"
+    ).encode()
+
+
+def _get_request(target, host):
+    return (
+        f"GET {target} HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        f"Connection: close\r\n"
+        f"\r\n"
+    ).encode()
+
+
+def _parse_head(head):
+    return _parse_status_line(head.split(b'\r\n', 1)[0])
+
+
+def _parse_status_line(status_line):
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+        return None
+    try:
+        return int(parts[1])
+    except ValueError:
+        return None
+
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
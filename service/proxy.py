@@ -1,20 +1,30 @@
 """
 Implements a Proxy model as a table in SQLite database (using SQLAlchemy)
+
+The database works in WAL mode (see set_sqlite_pragmas), so the readers
+(API) and the writer (tasks) do not block each other. The schema of an
+existing database is upgraded on import by 'migrate' (it can also be run
+with manage.py migrate).
 """
 
 import os
 import socket
 import logging
 import threading
-from datetime import datetime
+from math import ceil
+from time import monotonic
+from datetime import datetime, timedelta
+from collections import namedtuple
 
 import requests
 import requests.exceptions
-from sqlalchemy import create_engine, Column, String, Integer, Float, \
-                       DateTime, Boolean, UniqueConstraint
+from sqlalchemy import create_engine, event, bindparam, select, func, \
+                       Table, Column, String, Integer, Float, DateTime, \
+                       Boolean, UniqueConstraint, Index, inspect
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+from . import probe
 from .geoip import GeoipDB
 
 
@@ -24,18 +34,125 @@ PROXY_DB_PATH = os.environ.get('PROXY_DB_PATH', 'tmp/proxy.db')
 # URL to check proxy
 TRY_URL = os.environ.get('TRY_URL', 'http://example.org/')
 
+# Text expected in the beginning of TRY_URL content (empty means any)
+TRY_CONTENT = os.environ.get('TRY_CONTENT', '')
+
+# How to request TRY_URL through proxy: 'socket' (minimal HTTP exchange on
+# the socket of the port check, see probe.verify) or 'requests'
+PROXY_VERIFIER = os.environ.get('PROXY_VERIFIER', 'socket')
+
 # Timeout for check proxy
 CHECK_TIMEOUT = 3.0
 
+# Timeout to connect to the port of proxy
+CONNECT_TIMEOUT = 1.0
+
+# Timeouts for a proxy with latency history are this factor times its
+# latency_p95, but not less than the minimal timeouts below and not greater
+# than CONNECT_TIMEOUT and CHECK_TIMEOUT (see Proxy.get_timeouts)
+ADAPTIVE_TIMEOUT_FACTOR = float(
+    os.environ.get('ADAPTIVE_TIMEOUT_FACTOR', '3.0')
+)
+MIN_CONNECT_TIMEOUT = 0.3
+MIN_CHECK_TIMEOUT = 0.5
+
+# Short timeouts for new candidates while searching for proxies (most of
+# them do not respond at all)
+SEARCH_CONNECT_TIMEOUT = float(
+    os.environ.get('SEARCH_CONNECT_TIMEOUT', '0.5')
+)
+SEARCH_CHECK_TIMEOUT = float(os.environ.get('SEARCH_CHECK_TIMEOUT', '1.5'))
+
 # Coef to modify proxy score (see Proxy.score_up and Proxy.score_down)
 SCORE_COEF = 0.25
 
+# Coef of the exponentially weighted moving average of latency
+LATENCY_COEF = 0.25
+
+# The number of recent latency samples to calculate the percentile by
+LATENCY_SAMPLES = 20
+
+# Percentile of the recent latency samples to keep in Proxy.latency_p95
+LATENCY_PERCENTILE = 0.95
+
+# How often to check active proxies
+ACTIVE_CHECK_INTERVAL = timedelta(hours=1)
+
+# The shortest interval between the checks of an inactive proxy, it is the
+# delay after a proxy has just failed
+MIN_INACTIVE_INTERVAL = timedelta(minutes=1)
+
+# The number of rows in one transaction of Proxy.update_many
+PROXY_UPDATE_BATCH_SIZE = int(
+    os.environ.get('PROXY_UPDATE_BATCH_SIZE', '1000')
+)
+
+# How long (in seconds) to keep the rows of the change log (see log_changes)
+CHANGE_LOG_RETENTION = float(
+    os.environ.get('CHANGE_LOG_RETENTION', '86400.0')
+)
+
+# Size of SQLite page cache in KiB
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', '20000'))
+
+# How long (in milliseconds) to wait for a lock of SQLite database
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', '10000'))
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tunes a new SQLite connection (a listener of 'connect' event). WAL lets
+    readers work while a writer commits, and synchronous=NORMAL is safe in
+    WAL mode and does not fsync on every commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+# Timings of a successful check (in seconds): the time to connect to the
+# proxy and the time to the first byte of the response to TRY_URL
+Latency = namedtuple('Latency', ('connect_time', 'ttfb'))
+
 
 engine = create_engine(f'sqlite:///{PROXY_DB_PATH}')
+event.listen(engine, 'connect', set_sqlite_pragmas)
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
 
+# Single row table with the version of the proxy data, it is incremented in
+# the same transaction as every write that changes the list of active
+# proxies (see bump_data_version)
+data_version_table = Table(
+    'data_version', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('version', Integer, nullable=False),
+    Column('pruned_version', Integer, nullable=False, default=0,
+           server_default='0'),
+)
+
+
+# Append-only log of the proxies changed in the list of active ones (added,
+# changed or removed) with the data version of the change, it is written in
+# the same transaction as the proxies (see log_changes). 'pruned_version' of
+# data_version is the latest version removed from the log by retention.
+proxy_change_table = Table(
+    'proxy_change', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('version', Integer, nullable=False),
+    Column('host', String, nullable=False),
+    Column('port', Integer, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Index('proxy_change_version_idx', 'version'),
+    Index('proxy_change_created_idx', 'created_at'),
+)
+
+
 class SessionThreadPool:
     """
     It is a pool of sessions for each theard. It contains the method 'get'
@@ -74,9 +191,20 @@ class Proxy(Base):
     region = Column(String, nullable=False)
     city = Column(String, nullable=False)
     score = Column(Float, nullable=False, default=0.0)
+    next_check_at = Column(DateTime)
+    connect_time = Column(Float)
+    ttfb = Column(Float)
+    latency = Column(Float)
+    latency_p95 = Column(Float)
+    latency_samples = Column(String)
 
     __table_args__ = (
         UniqueConstraint('host', 'port', name='host_port_uix'),
+        Index('proxy_active_score_idx', 'is_active', 'score'),
+        Index('proxy_active_check_idx', 'is_active', 'last_check_at'),
+        Index('proxy_location_idx', 'country', 'region', 'city'),
+        Index('proxy_active_next_check_idx', 'is_active', 'next_check_at'),
+        Index('proxy_check_idx', 'last_check_at'),
     )
 
     def __repr__(self):
@@ -89,7 +217,8 @@ class Proxy(Base):
         return {
             key: getattr(self, key)
             for key in ('host', 'port', 'created_at', 'country',
-                        'region', 'city', 'score', 'last_check_at')
+                        'region', 'city', 'score', 'last_check_at',
+                        'latency', 'latency_p95')
         }
 
     def create(self, session):
@@ -114,24 +243,89 @@ class Proxy(Base):
         if self.region is None:
             self.region = geo_info['region']
 
+        if self.next_check_at is None:
+            self.schedule()
+
         session.add(self)
+        if self.is_active:
+            log_changes(session, bump_data_version(session), [self])
         session.commit()
 
         logging.debug(f"Proxy {self} inserted")
 
     def exists(self, session):
         """
-        Returns true of such proxy exists in the table.
+        Returns true if a proxy with the same host exists in the table (the
+        host is the primary key, so the port does not matter).
         """
-        return self.__class__.get(session, self.host, self.port) is not None
+        return session.query(self.__class__.host) \
+            .filter_by(host=self.host).first() is not None
 
-    def check(self):
+    def check(self, connect_timeout=CONNECT_TIMEOUT,
+              check_timeout=CHECK_TIMEOUT):
         """
         Checks the proxy for work. First, it checks the open port in the host.
         Second, it tries to request TRY_URL through proxy and to get the
-        correct response.
+        correct response. On success the latency is updated (see
+        add_latency).
+        """
+        started_at = monotonic()
+        sock = self._check_open_port(connect_timeout)
+        if sock is None:
+            return False
+        connect_time = monotonic() - started_at
+
+        # The socket verifier sends the request through the same connection
+        if PROXY_VERIFIER != 'socket':
+            sock.close()
+            sock = None
+        try:
+            ttfb = self._try_proxy(check_timeout, sock)
+        finally:
+            if sock is not None:
+                sock.close()
+        if ttfb is None:
+            return False
+        self.add_latency(Latency(connect_time, ttfb))
+        return True
+
+    def get_timeouts(self):
+        """
+        Returns the timeouts (connect_timeout, check_timeout) adapted to the
+        latency history of the proxy, so a dead proxy does not hold a slot
+        of the checker for the full timeout. Without history they are
+        CONNECT_TIMEOUT and CHECK_TIMEOUT.
+        """
+        if self.latency_p95 is None:
+            return CONNECT_TIMEOUT, CHECK_TIMEOUT
+        timeout = self.latency_p95 * ADAPTIVE_TIMEOUT_FACTOR
+        return (
+            min(max(timeout, MIN_CONNECT_TIMEOUT), CONNECT_TIMEOUT),
+            min(max(timeout, MIN_CHECK_TIMEOUT), CHECK_TIMEOUT),
+        )
+
+    def add_latency(self, latency):
+        """
+        Updates the latency fields by the timings of a successful check:
+        the last connect_time and ttfb, the moving average of their sum
+        (latency) and its percentile over the recent checks (latency_p95).
         """
-        return self._check_open_port() and self._try_proxy()
+        total = latency.connect_time + latency.ttfb
+        self.connect_time = latency.connect_time
+        self.ttfb = latency.ttfb
+
+        if self.latency is None:
+            self.latency = total
+        else:
+            self.latency = self.latency * (1 - LATENCY_COEF) + \
+                total * LATENCY_COEF
+
+        samples = self.latency_samples.split(',') \
+            if self.latency_samples else []
+        samples = samples[-(LATENCY_SAMPLES - 1):] + [f"{total:.4f}"]
+        self.latency_samples = ','.join(samples)
+        self.latency_p95 = get_percentile(map(float, samples),
+                                          LATENCY_PERCENTILE)
 
     def score_up(self):
         """
@@ -145,6 +339,17 @@ class Proxy(Base):
         """
         self.score = self.score * (1 - SCORE_COEF)
 
+    def schedule(self):
+        """
+        Sets the time of the next check after last_check_at. Active proxies
+        are checked every ACTIVE_CHECK_INTERVAL, inactive ones back off: the
+        longer a proxy has been inactive, the later it is checked again (but
+        not earlier than MIN_INACTIVE_INTERVAL).
+        """
+        self.next_check_at = get_next_check_at(
+            self.is_active, self.last_check_at, self.inactive_since
+        )
+
     @classmethod
     def get(cls, session, host, port):
         """
@@ -166,28 +371,306 @@ class Proxy(Base):
         """
         return session.query(cls).filter_by(is_active=False)
 
-    def _check_open_port(self):
+    @classmethod
+    def list_due(cls, session, is_active, now, limit=None):
+        """
+        Returns active or inactive proxies that are due to check at 'now'
+        in order of next_check_at.
+        """
+        query = session.query(cls).filter(
+            cls.is_active == is_active, cls.next_check_at <= now,
+        ).order_by(cls.next_check_at)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def get_next_due(cls, session, is_active):
+        """
+        Returns the nearest next_check_at of active or inactive proxies or
+        None if there are no such proxies.
+        """
+        return session.query(func.min(cls.next_check_at)).filter(
+            cls.is_active == is_active
+        ).scalar()
+
+    @classmethod
+    def update_many(cls, proxy_list, engine=engine,
+                    batch_size=PROXY_UPDATE_BATCH_SIZE):
+        """
+        Saves the check results (is_active, inactive_since, score,
+        last_check_at, next_check_at and latency fields) of the proxies with
+        bulk UPDATEs, one transaction per batch of 'batch_size' rows. Use it
+        instead of committing each proxy separately, the pending changes of
+        the proxies in their session must be discarded after that
+        (session.rollback()). The proxies seen in the list of active ones
+        are added to the change log and the data version is bumped in the
+        same transaction (if there are such proxies).
+        """
+        table = cls.__table__
+        query = table.update().where(table.c.host == bindparam('b_host'))
+        for idx in range(0, len(proxy_list), batch_size):
+            batch = proxy_list[idx:idx + batch_size]
+            with engine.begin() as conn:
+                conn.execute(query, [cls._get_update_params(proxy)
+                                     for proxy in batch])
+                # The version changes only if the list of active proxies
+                # changes
+                listed = [proxy for proxy in batch if proxy.is_listed_change]
+                if listed:
+                    log_changes(conn, bump_data_version(conn), listed)
+
+    @staticmethod
+    def _get_update_params(proxy):
+        return {
+            'b_host': proxy.host,
+            'is_active': proxy.is_active,
+            'inactive_since': proxy.inactive_since,
+            'score': proxy.score,
+            'last_check_at': proxy.last_check_at,
+            'next_check_at': proxy.next_check_at,
+            'connect_time': proxy.connect_time,
+            'ttfb': proxy.ttfb,
+            'latency': proxy.latency,
+            'latency_p95': proxy.latency_p95,
+            'latency_samples': proxy.latency_samples,
+        }
+
+    @property
+    def is_listed_change(self):
+        """
+        True if the pending changes of the proxy are seen in the list of
+        active proxies: an active proxy may change its score and latency, an
+        inactive one is seen only if it has just become inactive.
+        """
+        if self.is_active:
+            return True
+        history = inspect(self).attrs.is_active.history
+        return bool(history.deleted and history.deleted[0])
+
+    def _check_open_port(self, timeout=CONNECT_TIMEOUT):
+        # Returns the connected socket or None if the port is not open
         logging.debug(f"Checking open port for {self}")
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1.0)
-        result = sock.connect_ex((self.host, self.port))
-        sock.close()
-        return result == 0
-
-    def _try_proxy(self):
+        sock.settimeout(timeout)
+        if sock.connect_ex((self.host, self.port)) != 0:
+            sock.close()
+            return None
+        return sock
+
+    def _try_proxy(self, timeout=CHECK_TIMEOUT, sock=None):
+        # Returns the time to the first byte of the response or None if
+        # the proxy does not work. If 'sock' (connected to the proxy) is
+        # given, the request is sent through it.
         logging.debug(f"Trying proxy {self}")
+        if sock is not None:
+            timings = {}
+            success = probe.verify(sock, TRY_URL, timeout,
+                                   TRY_CONTENT.encode(), timings)
+            return timings['ttfb'] if success else None
+
         proxies = {"https": f"http://{self.host}:{self.port}"}
         try:
             with requests.get(TRY_URL, proxies=proxies,
-                              timeout=CHECK_TIMEOUT) as response:
-                return response.status_code == 200
+                              timeout=timeout) as response:
+                if response.status_code == 200 and \
+                        TRY_CONTENT in response.text:
+                    # The time until the response headers are parsed
+                    return response.elapsed.total_seconds()
+                return None
         except (requests.exceptions.ProxyError,
                 requests.exceptions.ConnectTimeout,
                 requests.exceptions.SSLError,
                 requests.exceptions.ConnectionError,
                 requests.exceptions.ReadTimeout) as exc:
-            return False
+            return None
+
+
+def bump_data_version(conn):
+    """
+    Increments the data version in the transaction of 'conn' (a connection
+    or a session) and returns the new version.
+    """
+    conn.execute(
+        data_version_table.update()
+        .where(data_version_table.c.id == 1)
+        .values(version=data_version_table.c.version + 1)
+    )
+    return get_data_version(conn)
+
+
+def get_data_version(conn):
+    """
+    Returns the current data version. It grows on every write that changes
+    the list of active proxies, so readers can tell if it has changed.
+    """
+    return conn.execute(
+        select([data_version_table.c.version])
+        .where(data_version_table.c.id == 1)
+    ).scalar() or 0
+
+
+def log_changes(conn, version, proxy_list, now=None):
+    """
+    Appends the proxies to the change log with given data version in the
+    transaction of 'conn' (a connection or a session), and removes the rows
+    older than CHANGE_LOG_RETENTION.
+    """
+    now = now or datetime.now()
+    if proxy_list:
+        conn.execute(proxy_change_table.insert(), [
+            {'version': version, 'host': proxy.host, 'port': proxy.port,
+             'created_at': now}
+            for proxy in proxy_list
+        ])
+
+    table = proxy_change_table
+    pruned_version = conn.execute(
+        select([func.max(table.c.version)]).where(
+            table.c.created_at < now - timedelta(seconds=CHANGE_LOG_RETENTION)
+        )
+    ).scalar()
+    if pruned_version is not None:
+        conn.execute(table.delete().where(table.c.version <= pruned_version))
+        conn.execute(
+            data_version_table.update()
+            .where(data_version_table.c.id == 1)
+            .where(data_version_table.c.pruned_version < pruned_version)
+            .values(pruned_version=pruned_version)
+        )
+
+
+def get_pruned_version(conn):
+    """
+    Returns the latest data version removed from the change log, the log has
+    all the changes after it.
+    """
+    return conn.execute(
+        select([data_version_table.c.pruned_version])
+        .where(data_version_table.c.id == 1)
+    ).scalar() or 0
+
+
+def get_percentile(values, q):
+    """
+    Returns the percentile 'q' (from 0 to 1) of 'values' by the nearest rank
+    method.
+    """
+    values = sorted(values)
+    return values[max(0, ceil(q * len(values)) - 1)]
+
+
+def get_next_check_at(is_active, last_check_at, inactive_since):
+    """
+    Returns the time of the next check of proxy (see Proxy.schedule).
+    """
+    if is_active or inactive_since is None:
+        return last_check_at + ACTIVE_CHECK_INTERVAL
+    return last_check_at + max(last_check_at - inactive_since,
+                               MIN_INACTIVE_INTERVAL)
+
+
+def migrate(engine):
+    """
+    Creates missing tables and upgrades the schema of the database with the
+    steps from MIGRATIONS that have not been applied yet. The number of
+    applied steps is kept in 'PRAGMA user_version'. The steps must be
+    idempotent, because the API and the tasks may start at the same time.
+    """
+    Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        version = conn.execute("PRAGMA user_version").scalar()
+        for step in MIGRATIONS[version:]:
+            logging.info(f"Apply migration {step.__name__}")
+            with conn.begin():
+                step(conn)
+        if version < len(MIGRATIONS):
+            conn.execute(f"PRAGMA user_version={len(MIGRATIONS)}")
+
+
+def _create_indexes(conn, names):
+    existing = {
+        row[1] for row in conn.execute("PRAGMA index_list(proxy)")
+    }
+    for index in Proxy.__table__.indexes:
+        if index.name in names and index.name not in existing:
+            index.create(conn)
+
+
+def _migration_indexes(conn):
+    _create_indexes(conn, ('proxy_active_score_idx', 'proxy_active_check_idx',
+                           'proxy_location_idx'))
+
+
+def _add_columns(conn, columns, table='proxy'):
+    existing = {
+        row[1] for row in conn.execute(f"PRAGMA table_info({table})")
+    }
+    for name, type_ in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_}")
+
+
+def _migration_next_check_at(conn):
+    _add_columns(conn, [('next_check_at', 'DATETIME')])
+
+    table = Proxy.__table__
+    rows = conn.execute(
+        select([table.c.host, table.c.is_active, table.c.last_check_at,
+                table.c.inactive_since])
+        .where(table.c.next_check_at.is_(None))
+    ).fetchall()
+    if rows:
+        conn.execute(
+            table.update().where(table.c.host == bindparam('b_host')),
+            [
+                {
+                    'b_host': row.host,
+                    'next_check_at': get_next_check_at(
+                        row.is_active, row.last_check_at, row.inactive_since
+                    ),
+                }
+                for row in rows
+            ]
+        )
+    _create_indexes(conn, ('proxy_active_next_check_idx',))
+
+
+def _migration_latency(conn):
+    _add_columns(conn, [
+        ('connect_time', 'FLOAT'), ('ttfb', 'FLOAT'), ('latency', 'FLOAT'),
+        ('latency_p95', 'FLOAT'), ('latency_samples', 'VARCHAR'),
+    ])
+
+
+def _migration_data_version(conn):
+    # The table itself is created by create_all
+    if conn.execute(select([func.count()])
+                    .select_from(data_version_table)).scalar() == 0:
+        conn.execute(data_version_table.insert().values(id=1, version=1))
+
+
+def _migration_change_log(conn):
+    # The table proxy_change itself is created by create_all
+    _add_columns(conn, [('pruned_version', 'INTEGER NOT NULL DEFAULT 0')],
+                 table='data_version')
+
+
+def _migration_check_idx(conn):
+    # For the incremental reads of ProxySnapshotManager
+    _create_indexes(conn, ('proxy_check_idx',))
+
+
+# Steps of migration in order, the new ones go to the end
+MIGRATIONS = [
+    _migration_indexes,
+    _migration_next_check_at,
+    _migration_latency,
+    _migration_data_version,
+    _migration_change_log,
+    _migration_check_idx,
+]
 
 
 # Encure the table for Proxy in the database
-Base.metadata.create_all(engine)
+migrate(engine)
@@ -6,68 +6,64 @@ Use example:
     proxy_searcher = ProxySearcher(threads_num=1000)
     for proxy in proxy_searcher.search(count=10):
         ...
+
+Instead of random addresses it can walk a scanner (see AddressPermutation):
+
+    scanner = AddressPermutation(ProxySearcher.ports)
+    proxy_searcher = ProxySearcher(threads_num=1000, scanner=scanner)
 """
 
-import threading
-from queue import Queue
+import logging
 from random import randint, choice
 
-from .proxy import Proxy
+from .proxy import Proxy, SEARCH_CONNECT_TIMEOUT, SEARCH_CHECK_TIMEOUT
+from .thread_pool import ThreadPool, TaskError
 
 
 class ProxySearcher:
     # Ports list to search for proxies
     ports = (8080, 3128)
 
-    def __init__(self, threads_num):
+    def __init__(self, threads_num, scanner=None):
         self._threads_num = threads_num
+        self._scanner = scanner
 
     def search(self, count=None):
         """
         A generator that yields found proxies. 'count' is the number of proxies
         to find. If 'count' is None, the generator is infinite.
         """
-        # Queue to fill proxies by threads
-        queue = Queue()
-
-        # Stop event for the threads
-        stop_event = threading.Event()
-
-        # Threads to search for proxies
-        threads = [
-            threading.Thread(target=self._find_target,
-                             args=(queue, stop_event))
-            for _ in range(self._threads_num)
-        ]
-
-        # Start threads
-        list(map(threading.Thread.start, threads))
-
-        if count is not None:
-            # Finite loop to search for proxies
-            for _ in range(count):
-                # Yield proxies that threads put into the queue
-                yield queue.get(block=True)
-
-            # Stop the threads by setting stop_event
-            stop_event.set()
-
-            # Wait until all threads are stopped
-            list(map(threading.Thread.join, threads))
-
-        else:
-            # Infinite loop to search for proxies
-            while True:
-                # Yield proxies that threads put into the queue
-                yield queue.get(block=True)
-
-    def _find_target(self, queue, stop_event):
-        while not stop_event.is_set():
-            proxy = self._get_random_proxy()
-            if proxy.check():
-                queue.put(proxy)
+        found = 0
+        with ThreadPool(self._threads_num) as thread_pool:
+            # The addresses are taken lazily, as the threads get free
+            for result in thread_pool.imap_unordered(self._check,
+                                                     self._generate()):
+                if isinstance(result, TaskError):
+                    logging.error(f"Failed to check {result.item}: "
+                                  f"{result.exception!r}")
+                elif result is not None:
+                    yield result
+                    found += 1
+                    if found == count:
+                        break
+
+        # Keep the position of the scan for the next search
+        if self._scanner is not None:
+            self._scanner.save()
+
+    def _generate(self):
+        while True:
+            yield self._get_random_proxy()
+
+    def _check(self, proxy):
+        if proxy.check(SEARCH_CONNECT_TIMEOUT, SEARCH_CHECK_TIMEOUT):
+            return proxy
+        return None
 
     def _get_random_proxy(self):
+        if self._scanner is not None:
+            host, port = next(self._scanner)
+            return Proxy(host=host, port=port)
         host = ".".join(str(randint(0, 255)) for _ in range(4))
         port = choice(self.ports)
         return Proxy(host=host, port=port)
@@ -0,0 +1,275 @@
+"""
+AddressPermutation walks the whole space of IPv4 addresses and ports in a
+pseudo-random order without repeats (the same way zmap does). The order is
+given by the cyclic multiplicative group of integers modulo a prime p that
+is a bit greater than the size of the space: x -> x * g mod p, where g is a
+primitive root, visits every number in [1, p - 1] exactly once. Numbers out
+of the space and addresses from bogon and excluded ranges are skipped.
+
+The position in the cycle (cursor) is saved to a JSON file from time to
+time, so a restarted search carries on where it stopped.
+
+Example:
+
+    scanner = AddressPermutation(ports=(8080, 3128),
+                                 cursor_path='tmp/scan_cursor.json')
+    for host, port in scanner:
+        ...
+"""
+
+import os
+import json
+import socket
+import logging
+import threading
+import ipaddress
+from bisect import bisect_right
+from random import Random, randrange
+
+
+# Path to the file to save the position of the scan
+PROXY_SCAN_CURSOR_PATH = os.environ.get('PROXY_SCAN_CURSOR_PATH',
+                                        'tmp/scan_cursor.json')
+
+# Extra ranges to exclude from the scan (comma separated CIDRs)
+PROXY_SCAN_EXCLUDE = os.environ.get('PROXY_SCAN_EXCLUDE', '')
+
+# Ranges that are not routable in the public Internet
+BOGON_NETWORKS = (
+    '0.0.0.0/8',          # "This" network
+    '10.0.0.0/8',         # Private
+    '100.64.0.0/10',      # Carrier-grade NAT
+    '127.0.0.0/8',        # Loopback
+    '169.254.0.0/16',     # Link local
+    '172.16.0.0/12',      # Private
+    '192.0.0.0/24',       # IETF protocol assignments
+    '192.0.2.0/24',       # TEST-NET-1
+    '192.88.99.0/24',     # 6to4 relay anycast
+    '192.168.0.0/16',     # Private
+    '198.18.0.0/15',      # Benchmarking
+    '198.51.100.0/24',    # TEST-NET-2
+    '203.0.113.0/24',     # TEST-NET-3
+    '224.0.0.0/4',        # Multicast
+    '240.0.0.0/4',        # Reserved and broadcast
+)
+
+# How many addresses to yield between saves of the cursor
+SAVE_EVERY = 10000
+
+# Bases for deterministic Miller-Rabin test of numbers less than 3.3e24
+_PRIME_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+
+class AddressPermutation:
+    """
+    Thread safe iterator over (host, port) in a random full-cycle order.
+    When the cycle is over, a new random cycle starts.
+
+    The cycle can be split into 'shards' disjoint parts: the shard number
+    'shard' visits every shards-th element of the cycle. All the shards must
+    be created with the same 'seed' to walk the same cycle.
+    """
+
+    # The number of addresses in the space
+    addresses_num = 2**32
+
+    # Ranges that are always skipped
+    bogon_networks = BOGON_NETWORKS
+
+    def __init__(self, ports, cursor_path=None, exclude=(), shard=0,
+                 shards=1, seed=None):
+        self._ports = tuple(ports)
+        self._cursor_path = cursor_path
+        self._shard = shard
+        self._shards = shards
+        self._size = self.addresses_num * len(self._ports)
+        self._prime = _next_prime(self._size + 1)
+        self._factors = _prime_factors(self._prime - 1)
+        self._excluded = _merge_ranges(self.bogon_networks + tuple(exclude))
+        self._excluded_starts = [start for start, _ in self._excluded]
+        self._lock = threading.Lock()
+        self._counter = 0
+
+        if not (cursor_path and self._load()):
+            self.seed = randrange(2**63) if seed is None else seed
+            self._start_cycle(0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            while True:
+                # Position of the element in the cycle (from 1 to p - 1)
+                self._position += self._shards
+                if self._position >= self._prime:
+                    logging.info("Scan cycle is complete, start a new one")
+                    self._start_cycle(self._cycle + 1)
+                    continue
+                self._current = self._current * self._step % self._prime
+
+                value = self._current - 1
+                if value >= self._size:
+                    continue
+
+                ip, port_idx = divmod(value, len(self._ports))
+                if self._is_excluded(ip):
+                    continue
+
+                self._counter += 1
+                if self._counter % SAVE_EVERY == 0:
+                    self._save()
+
+                host = socket.inet_ntoa(ip.to_bytes(4, 'big'))
+                return host, self._ports[port_idx]
+
+    def save(self):
+        """
+        Saves the cursor to the file.
+        """
+        with self._lock:
+            self._save()
+
+    @staticmethod
+    def load_seed(cursor_path):
+        """
+        Returns the seed saved in the cursor file or None.
+        """
+        try:
+            with open(cursor_path) as f:
+                return json.load(f)['seed']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _start_cycle(self, cycle, position=None):
+        # Parameters of the cycle depend on the seed only, so all the shards
+        # get the same cycle
+        rnd = Random(f"{self.seed}:{cycle}")
+        self._cycle = cycle
+        self._generator = self._random_primitive_root(rnd)
+        self._start = rnd.randrange(1, self._prime)
+        self._step = pow(self._generator, self._shards, self._prime)
+        if position is None:
+            position = self._shard + 1 - self._shards
+        self._position = position
+        self._current = self._start * \
+            _pow_mod(self._generator, position, self._prime) % self._prime
+        self._save()
+
+    def _random_primitive_root(self, rnd):
+        while True:
+            g = rnd.randrange(2, self._prime - 1)
+            if all(pow(g, (self._prime - 1) // q, self._prime) != 1
+                   for q in self._factors):
+                return g
+
+    def _is_excluded(self, ip):
+        idx = bisect_right(self._excluded_starts, ip) - 1
+        return idx >= 0 and ip <= self._excluded[idx][1]
+
+    def _load(self):
+        try:
+            with open(self._cursor_path) as f:
+                cursor = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if cursor.get('prime') != self._prime or \
+                cursor.get('ports') != list(self._ports) or \
+                cursor.get('shard') != self._shard or \
+                cursor.get('shards') != self._shards:
+            logging.info("Scan cursor does not match the scan, ignore it")
+            return False
+
+        self.seed = cursor['seed']
+        self._start_cycle(cursor['cycle'], cursor['position'])
+        logging.info(f"Scan resumed from cursor {self._cursor_path}")
+        return True
+
+    def _save(self):
+        if not self._cursor_path:
+            return
+        cursor = {
+            'prime': self._prime,
+            'ports': list(self._ports),
+            'shard': self._shard,
+            'shards': self._shards,
+            'seed': self.seed,
+            'cycle': self._cycle,
+            'position': self._position,
+        }
+        tmp_path = self._cursor_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cursor, f)
+        os.replace(tmp_path, self._cursor_path)
+
+
+def parse_exclude(value):
+    """
+    Parses comma separated CIDRs (like PROXY_SCAN_EXCLUDE) into a tuple.
+    """
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def _merge_ranges(networks):
+    ranges = sorted(
+        (int(net.network_address), int(net.broadcast_address))
+        for net in map(ipaddress.IPv4Network, networks)
+    )
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _pow_mod(base, exp, mod):
+    # Negative exponent means the power of the inverse
+    if exp < 0:
+        return pow(pow(base, mod - 2, mod), -exp, mod)
+    return pow(base, exp, mod)
+
+
+def _next_prime(n):
+    while not _is_prime(n):
+        n += 1
+    return n
+
+
+def _is_prime(n):
+    if n < 2:
+        return False
+    for p in _PRIME_BASES:
+        if n % p == 0:
+            return n == p
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for a in _PRIME_BASES:
+        x = pow(a, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _prime_factors(n):
+    factors = []
+    q = 2
+    while q * q <= n:
+        if n % q == 0:
+            factors.append(q)
+            while n % q == 0:
+                n //= q
+        q += 1
+    if n > 1:
+        factors.append(n)
+    return factors
@@ -0,0 +1,162 @@
+"""
+ShardedProxySearcher implements a search for proxies in several processes.
+The address space (see AddressPermutation) is split into shards, each
+process runs AsyncProxySearcher over its own shard and sends found proxies
+back in batches. The process that iterates 'search' is the only one that
+receives them, so it can be the single writer to the database.
+
+Use example:
+
+    proxy_searcher = ShardedProxySearcher(processes=4, concurrency=10000,
+                                          cursor_path='tmp/scan_cursor.json')
+    for proxy in proxy_searcher.search(count=10):
+        ...
+"""
+
+import logging
+import threading
+import traceback
+import multiprocessing as mp
+from queue import Queue, Empty
+from random import randrange
+from time import monotonic
+
+from .proxy import Proxy, Latency
+from .proxy_searcher import ProxySearcher
+from .async_proxy_searcher import AsyncProxySearcher, SearchError
+from .scanner import AddressPermutation
+
+
+class ShardedProxySearcher:
+    # Ports list to search for proxies
+    ports = ProxySearcher.ports
+
+    # Maximal number of proxies in a batch
+    batch_size = 100
+
+    # Maximal time (in seconds) a found proxy waits in a batch
+    batch_timeout = 5.0
+
+    def __init__(self, processes, concurrency, verify_concurrency=None,
+                 cursor_path=None, exclude=(), permutation=True):
+        self._processes = processes
+        self._concurrency = concurrency
+        self._verify_concurrency = verify_concurrency
+        self._cursor_path = cursor_path
+        self._exclude = tuple(exclude)
+        self._permutation = permutation
+
+    def search(self, count=None):
+        """
+        A generator that yields found proxies. 'count' is the number of proxies
+        to find. If 'count' is None, the generator is infinite.
+        """
+        # Queue for batches from the worker processes
+        queue = mp.Queue()
+
+        # Stop event for the worker processes
+        stop_event = mp.Event()
+
+        # All the shards walk the same cycle, so they share the seed
+        seed = None
+        if self._cursor_path:
+            seed = AddressPermutation.load_seed(self._shard_path(0))
+        if seed is None:
+            seed = randrange(2**63)
+
+        processes = [
+            mp.Process(target=self._run_shard,
+                       args=(shard, seed, queue, stop_event), daemon=True)
+            for shard in range(self._processes)
+        ]
+        list(map(mp.Process.start, processes))
+
+        try:
+            found = 0
+            while count is None or found < count:
+                # Yield proxies from the batches the workers put into the queue
+                batch = queue.get(block=True)
+                if isinstance(batch, SearchError):
+                    raise batch
+                for host, port, latency in batch:
+                    proxy = Proxy(host=host, port=port)
+                    if latency is not None:
+                        proxy.add_latency(latency)
+                    yield proxy
+                    found += 1
+                    if count is not None and found >= count:
+                        break
+
+        finally:
+            # Stop the workers and wait until they are stopped
+            stop_event.set()
+            for process in processes:
+                process.join(timeout=10.0)
+                if process.is_alive():
+                    process.terminate()
+
+    def _run_shard(self, shard, seed, queue, stop_event):
+        try:
+            scanner = None
+            if self._permutation:
+                scanner = AddressPermutation(
+                    self.ports, cursor_path=self._shard_path(shard),
+                    exclude=self._exclude, shard=shard,
+                    shards=self._processes, seed=seed,
+                )
+            proxy_searcher = AsyncProxySearcher(self._concurrency, scanner,
+                                                self._verify_concurrency)
+
+            # Found proxies are collected from the searcher in a thread, so
+            # the batches can be flushed by time
+            found_queue = Queue()
+            threading.Thread(
+                target=self._collect,
+                args=(proxy_searcher, found_queue, stop_event), daemon=True,
+            ).start()
+
+            while not stop_event.is_set():
+                batch = self._get_batch(found_queue)
+                if batch:
+                    queue.put(batch)
+
+            if scanner is not None:
+                scanner.save()
+
+        except Exception:
+            logging.error(traceback.format_exc())
+            queue.put(SearchError(f"Shard {shard} of ShardedProxySearcher "
+                                  f"failed"))
+
+    def _collect(self, proxy_searcher, found_queue, stop_event):
+        try:
+            for proxy in proxy_searcher.search():
+                latency = None
+                if proxy.connect_time is not None:
+                    latency = Latency(proxy.connect_time, proxy.ttfb)
+                found_queue.put((proxy.host, proxy.port, latency))
+                if stop_event.is_set():
+                    break
+        except SearchError as exc:
+            found_queue.put(exc)
+
+    def _get_batch(self, found_queue):
+        batch = []
+        deadline = monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = found_queue.get(timeout=timeout)
+            except Empty:
+                break
+            if isinstance(item, SearchError):
+                raise item
+            batch.append(item)
+        return batch
+
+    def _shard_path(self, shard):
+        if self._cursor_path:
+            return f"{self._cursor_path}.{shard}"
+        return None
@@ -0,0 +1,522 @@
+"""
+ProxySnapshot is an immutable in-memory copy of active proxies with indexes
+by country, region and city and a list sorted by score, so /list is served
+without queries to the database. ProxySnapshotManager keeps the snapshot
+actual: it refreshes it in a background thread, and each refresh reads only
+the rows checked since the previous one (with plain SQLAlchemy Core rows
+instead of ORM objects) and applies the changed ones to a copy of the
+snapshot (see ProxySnapshot.apply).
+
+Example:
+
+    snapshot_manager = ProxySnapshotManager()
+    snapshot = snapshot_manager.get()
+    proxy_list = snapshot.select(country='US', score=0.5, ordered=True)
+    fast_list = snapshot.select(max_latency=0.5, ordered='latency')
+
+    # The next page of 10 records after the last one
+    next_list = snapshot.select(count=10,
+                                after=get_key(proxy_list[-1]))
+
+    # The same list in the binary format (see binary.py)
+    data = snapshot.pack(country='US', score=0.5)
+
+    # 5 random proxies, the ones with higher score are drawn more often
+    random_list = snapshot.sample(5, country='US')
+"""
+
+import os
+import copy
+import json
+import random
+import base64
+import binascii
+import logging
+import threading
+import traceback
+from bisect import bisect_left, bisect_right
+from itertools import islice, takewhile
+from math import inf
+from collections import namedtuple
+from datetime import timedelta
+from time import sleep
+
+from sqlalchemy import select, func
+
+from .proxy import Proxy, engine, get_data_version
+from . import binary, utils
+
+
+# How often (in seconds) to refresh the snapshot
+SNAPSHOT_REFRESH_INTERVAL = float(
+    os.environ.get('SNAPSHOT_REFRESH_INTERVAL', '5.0')
+)
+
+# Rows checked this time (in seconds) before the latest seen check are read
+# again on refresh, it covers the rows committed a bit later than stamped
+SNAPSHOT_OVERLAP = float(os.environ.get('SNAPSHOT_OVERLAP', '60.0'))
+
+# Fields of the records with indexes in a snapshot
+INDEX_FIELDS = ('country', 'region', 'city')
+
+# Maximal number of alias tables (one per filter of 'sample') kept in a
+# snapshot
+SAMPLER_CACHE_SIZE = 64
+
+# Columns of the proxy table to keep in the snapshot
+RECORD_FIELDS = ('host', 'port', 'created_at', 'country', 'region', 'city',
+                 'score', 'last_check_at', 'latency', 'latency_p95')
+
+
+class ProxyRecord(namedtuple('ProxyRecord', RECORD_FIELDS)):
+    """
+    Compact read-only copy of a proxy row.
+    """
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"{self.host}:{self.port}"
+
+    def as_dict(self):
+        """
+        Represents proxy record as dictionary (like Proxy.as_dict).
+        """
+        return self._asdict()
+
+
+class ProxySnapshot:
+    """
+    Immutable set of active proxies with indexes and the data version it
+    was read at (see get_data_version). The records in by_score
+    and in the indexes by location are sorted by the key (score descendly,
+    host, port), so a page after a known key (see 'after' in 'iterate') is
+    found by bisection. The records of by_score are also packed in the
+    binary format beforehand (see binary.py).
+    """
+
+    def __init__(self, records, version=0):
+        self.version = version
+        self._by_key = {(record.host, record.port): record
+                        for record in records}
+        self.records = tuple(self._by_key.values())
+        self.by_score = sorted(self.records, key=get_key)
+        self._keys = [get_key(record) for record in self.by_score]
+        self._neg_scores = [-record.score for record in self.by_score]
+
+        # Records from the fastest one, the ones with unknown latency are at
+        # the end
+        self.by_latency = sorted(self.records, key=_get_latency_key)
+        self._latency_keys = [_get_latency_key(record)
+                              for record in self.by_latency]
+        self._latencies = [key[0] for key in self._latency_keys]
+
+        # by_score in the binary format, a prefix of it is served without
+        # work per record
+        self.packed = binary.pack_records(self.by_score)
+
+        # Lists of records and their keys in the order of by_score
+        self._indexes = {
+            field: _build_index(self.by_score, field)
+            for field in INDEX_FIELDS
+        }
+
+        # Records and their alias tables by the filters of 'sample', built
+        # on demand
+        self._samplers = utils.LRUCache(SAMPLER_CACHE_SIZE)
+
+    def apply(self, records, removed=(), version=None):
+        """
+        Returns a new snapshot with 'records' added (they replace the records
+        with the same host and port) and the records with the keys (host,
+        port) from 'removed' deleted. Only the places of the changed records
+        in the sorted lists, the indexes and the packed bytes are changed, so
+        nothing is sorted or packed again.
+        """
+        records = {(record.host, record.port): record for record in records}
+        version = self.version if version is None else version
+        old_records = [
+            self._by_key[key] for key in set(removed) | records.keys()
+            if key in self._by_key
+        ]
+        if not records and not old_records:
+            snapshot = copy.copy(self)
+            snapshot.version = version
+            return snapshot
+
+        by_key = dict(self._by_key)
+        by_score = list(self.by_score)
+        keys = list(self._keys)
+        neg_scores = list(self._neg_scores)
+        by_latency = list(self.by_latency)
+        latency_keys = list(self._latency_keys)
+        latencies = list(self._latencies)
+        packed = bytearray(self.packed)
+        size = binary.RECORD.size
+
+        # The lists of the changed values of the indexes are copied
+        indexes = {field: dict(index)
+                   for field, index in self._indexes.items()}
+        copied = set()
+
+        def get_group(field, value):
+            if (field, value) not in copied:
+                copied.add((field, value))
+                group, group_keys = indexes[field].get(value, ((), ()))
+                indexes[field][value] = (list(group), list(group_keys))
+            return indexes[field][value]
+
+        for record in old_records:
+            del by_key[(record.host, record.port)]
+            key = get_key(record)
+            idx = bisect_left(keys, key)
+            del by_score[idx], keys[idx], neg_scores[idx]
+            del packed[idx * size:(idx + 1) * size]
+            idx = bisect_left(latency_keys, _get_latency_key(record))
+            del by_latency[idx], latency_keys[idx], latencies[idx]
+            for field in INDEX_FIELDS:
+                group, group_keys = get_group(field, getattr(record, field))
+                idx = bisect_left(group_keys, key)
+                del group[idx], group_keys[idx]
+
+        for record in records.values():
+            by_key[(record.host, record.port)] = record
+            key = get_key(record)
+            idx = bisect_left(keys, key)
+            by_score.insert(idx, record)
+            keys.insert(idx, key)
+            neg_scores.insert(idx, -record.score)
+            packed[idx * size:idx * size] = binary.pack_record(record)
+            latency_key = _get_latency_key(record)
+            idx = bisect_left(latency_keys, latency_key)
+            by_latency.insert(idx, record)
+            latency_keys.insert(idx, latency_key)
+            latencies.insert(idx, latency_key[0])
+            for field in INDEX_FIELDS:
+                group, group_keys = get_group(field, getattr(record, field))
+                idx = bisect_left(group_keys, key)
+                group.insert(idx, record)
+                group_keys.insert(idx, key)
+
+        for field, value in copied:
+            if not indexes[field][value][0]:
+                del indexes[field][value]
+
+        snapshot = copy.copy(self)
+        snapshot.version = version
+        snapshot._by_key = by_key
+        snapshot.records = tuple(by_key.values())
+        snapshot.by_score = by_score
+        snapshot._keys = keys
+        snapshot._neg_scores = neg_scores
+        snapshot.by_latency = by_latency
+        snapshot._latency_keys = latency_keys
+        snapshot._latencies = latencies
+        snapshot.packed = bytes(packed)
+        snapshot._indexes = indexes
+        snapshot._samplers = utils.LRUCache(SAMPLER_CACHE_SIZE)
+        return snapshot
+
+    def __len__(self):
+        return len(self.records)
+
+    def select(self, country='', region='', city='', score=0.0,
+               ordered=False, count=0, max_latency=None, after=None):
+        """
+        Returns the list of records filtered and ordered like /list does.
+        'ordered' is False, True (or 'score') to sort by score descendly or
+        'latency' to sort by latency from the fastest (the records with
+        unknown latency go last). If 'max_latency' is given, the records with
+        unknown latency are skipped.
+        """
+        return list(self.iterate(country=country, region=region, city=city,
+                                 score=score, ordered=ordered, count=count,
+                                 max_latency=max_latency, after=after))
+
+    def pack(self, country='', region='', city='', score=0.0,
+             ordered=False, count=0, max_latency=None, after=None):
+        """
+        The same as 'select', but returns the records in the binary format
+        with the header (see binary.py). Without the filters by location
+        and latency, 'after' and ordering by latency, the records are taken
+        by score descendly from the precomputed bytes.
+        """
+        if country or region or city or max_latency is not None or \
+                after is not None or ordered == 'latency':
+            return binary.pack(self.version, self.iterate(
+                country=country, region=region, city=city, score=score,
+                ordered=ordered, count=count, max_latency=max_latency,
+                after=after,
+            ))
+
+        size = bisect_right(self._neg_scores, -score)
+        if count:
+            size = min(size, count)
+        data = memoryview(self.packed)[:size * binary.RECORD.size]
+        return binary.pack_header(self.version, size) + data
+
+    def sample(self, n, country='', region='', city='', score=0.0,
+               rng=random):
+        """
+        Returns up to 'n' different records drawn at random in proportion to
+        their score from the records filtered like 'select' does. The alias
+        table of the filter is built once per snapshot, so a call takes O(n)
+        after that.
+        """
+        key = (country, region, city, score)
+        sampler = self._samplers.get(key)
+        if sampler is None:
+            records = tuple(self.iterate(country=country, region=region,
+                                         city=city, score=score,
+                                         ordered=True))
+            table = utils.AliasTable([record.score for record in records])
+            sampler = (records, table)
+            self._samplers.put(key, sampler)
+        records, table = sampler
+
+        if n >= len(records):
+            return rng.sample(records, len(records))
+
+        # Draw again on repeats, it rarely takes much more than 'n' draws
+        # unless 'n' is close to the number of records
+        chosen = {}
+        for _ in range(4 * n + 16):
+            if len(chosen) == n:
+                break
+            idx = table.draw(rng)
+            chosen.setdefault(idx, records[idx])
+        result = list(chosen.values())
+        if len(result) < n:
+            result += _sample_rest(records, chosen, n - len(result), rng)
+        return result
+
+    def iterate(self, country='', region='', city='', score=0.0,
+                ordered=False, count=0, max_latency=None, after=None):
+        """
+        The same as 'select', but returns an iterator. It does not copy the
+        records unless ordered by latency with country, region or city, so
+        it takes constant memory. If 'after' (the key of a record, see
+        get_key) is given, the records are ordered by score and start right
+        after that key (keyset pagination).
+        """
+        filters = {
+            field: value
+            for field, value in (('country', country), ('region', region),
+                                 ('city', city))
+            if value
+        }
+        by_latency = ordered == 'latency' and after is None
+        if after is not None:
+            ordered = True
+
+        if filters:
+            # Start from the smallest index and check the rest of filters
+            candidates, keys = min(
+                (self._indexes[field].get(value, ((), ()))
+                 for field, value in filters.items()),
+                key=lambda e: len(e[0]),
+            )
+            start = 0 if after is None else bisect_right(keys, after)
+
+            # The candidates are ordered by score, so stop at the first
+            # record with less score
+            result = (
+                record for record in takewhile(
+                    lambda e: e.score >= score,
+                    islice(candidates, start, None),
+                )
+                if all(getattr(record, field) == value
+                       for field, value in filters.items())
+                and _match(record, score, max_latency)
+            )
+            if by_latency:
+                result = sorted(result, key=_get_latency_key)
+
+        elif by_latency:
+            # Records with the latency not greater than 'max_latency' are a
+            # prefix
+            size = len(self.by_latency) if max_latency is None else \
+                bisect_right(self._latencies, max_latency)
+            result = islice(self.by_latency, size)
+            if score:
+                result = (record for record in result
+                          if record.score >= score)
+
+        elif ordered:
+            # Records with the score not less than 'score' are a prefix
+            start = 0 if after is None else bisect_right(self._keys, after)
+            size = bisect_right(self._neg_scores, -score)
+            result = islice(self.by_score, start, max(start, size))
+            if max_latency is not None:
+                result = (record for record in result
+                          if _match(record, score, max_latency))
+
+        elif score or max_latency is not None:
+            result = (record for record in self.records
+                      if _match(record, score, max_latency))
+
+        else:
+            result = iter(self.records)
+
+        if count:
+            result = islice(result, count)
+        return iter(result)
+
+
+class ProxySnapshotManager:
+    """
+    Keeps the actual ProxySnapshot. The first call of 'get' loads the
+    snapshot and starts the background thread that refreshes it.
+    """
+
+    def __init__(self, engine=engine, interval=SNAPSHOT_REFRESH_INTERVAL,
+                 overlap=SNAPSHOT_OVERLAP):
+        self._engine = engine
+        self._interval = interval
+        self._overlap = timedelta(seconds=overlap)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._records = {}
+        self._watermark = None
+        self._stats = None
+        self._thread = None
+
+    def get(self):
+        """
+        Returns the current snapshot.
+        """
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self.refresh()
+                    self._thread = threading.Thread(target=self._run,
+                                                    daemon=True)
+                    self._thread.start()
+        return self._snapshot
+
+    def refresh(self):
+        """
+        Reads the rows changed since the previous refresh and applies them to
+        the snapshot if there are changes (see ProxySnapshot.apply).
+        """
+        table = Proxy.__table__
+        with self._engine.connect() as conn:
+            # Nothing changed if the data version, the latest check and the
+            # size are the same
+            version = get_data_version(conn)
+            stats = tuple(conn.execute(
+                select([func.max(table.c.last_check_at), func.count()])
+            ).first()) + (version,)
+            if stats == self._stats:
+                return
+            self._stats = stats
+
+            query = select(
+                [table.c[field] for field in RECORD_FIELDS] +
+                [table.c.is_active]
+            )
+            if self._watermark is not None:
+                query = query.where(
+                    table.c.last_check_at >= self._watermark - self._overlap
+                )
+            rows = conn.execute(query).fetchall()
+
+        upserted, removed = [], []
+        for row in rows:
+            key = (row.host, row.port)
+            if row.is_active:
+                record = ProxyRecord(*(row[field] for field in RECORD_FIELDS))
+                if self._records.get(key) != record:
+                    self._records[key] = record
+                    upserted.append(record)
+            elif self._records.pop(key, None) is not None:
+                removed.append(key)
+            if self._watermark is None or \
+                    row.last_check_at > self._watermark:
+                self._watermark = row.last_check_at
+
+        # The first snapshot is built from scratch, the next ones get only
+        # the changed records
+        if self._snapshot is None:
+            self._snapshot = ProxySnapshot(self._records.values(), version)
+        elif upserted or removed or version != self._snapshot.version:
+            self._snapshot = self._snapshot.apply(upserted, removed, version)
+        logging.debug(f"Snapshot refreshed with {len(rows)} rows, "
+                      f"{len(upserted)} changed and {len(removed)} removed "
+                      f"records, {len(self._snapshot)} active proxies")
+
+    def _run(self):
+        while True:
+            sleep(self._interval)
+            try:
+                self.refresh()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
+def get_key(record):
+    """
+    Returns the key of the record in the order of ProxySnapshot.by_score:
+    score descendly, then host and port.
+    """
+    return (-record.score, record.host, record.port)
+
+
+def encode_cursor(record):
+    """
+    Returns an opaque cursor that points right after the record (for
+    'after' in ProxySnapshot.iterate, see decode_cursor).
+    """
+    data = json.dumps([record.score, record.host, record.port])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the key (see get_key) by the cursor from encode_cursor. Raises
+    ValueError if the cursor is not valid.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        score, host, port = json.loads(data)
+    except (TypeError, ValueError, binascii.Error) as exc:
+        raise ValueError(f"Invalid cursor: {cursor}") from exc
+    if not isinstance(score, (int, float)) or not isinstance(host, str) or \
+            not isinstance(port, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return (-score, host, port)
+
+
+def _get_latency_key(record):
+    # Unknown latency goes last
+    latency = inf if record.latency is None else record.latency
+    return (latency, record.host, record.port)
+
+
+def _match(record, score, max_latency):
+    return record.score >= score and (
+        max_latency is None or
+        record.latency is not None and record.latency <= max_latency
+    )
+
+
+def _sample_rest(records, chosen, n, rng):
+    # Weighted sampling without replacement by the keys u^(1/score) of the
+    # records not chosen yet, it takes O(len(records))
+    rest = (record for idx, record in enumerate(records)
+            if idx not in chosen)
+    return sorted(
+        rest,
+        key=lambda e: rng.random() ** (1.0 / e.score) if e.score > 0 else 0.0,
+        reverse=True,
+    )[:n]
+
+
+def _build_index(records, field):
+    index = {}
+    for record in records:
+        index.setdefault(getattr(record, field), []).append(record)
+    return {
+        value: (records, [get_key(record) for record in records])
+        for value, records in index.items()
+    }
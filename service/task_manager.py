@@ -7,10 +7,8 @@ Example:
     task_manager = TaskManager()
 
     @task_manager.register
-    class TestTask(PeriodicTask):
-        timeout = 1.0
-
-        def handle(self):
+    class TestTask(BaseTask):
+        def run(self):
             print("test")
 
     task_manager.run()
@@ -35,29 +33,6 @@ class BaseTask:
         raise NotImplementedError()
 
 
-class PeriodicTask(BaseTask):
-    """
-    Abstract class for periotic tasks. it requires to define 'timeout' and
-    the method 'handle' that is called again and again infinitely with the
-    set timeout.
-    """
-
-    # Timeout between 'handle' calls
-    timeout = None
-
-    def run(self):
-        while True:
-            logging.info(f"Handle task '{self.__class__.__name__}'")
-            self.handle()
-            sleep(self.timeout)
-
-    def handle(self):
-        """
-        A handler for call periodically. Must be implemented.
-        """
-        raise NotImplementedError()
-
-
 class TaskManager:
     """
     Implements task manager that runs registered tasks in separate processes.
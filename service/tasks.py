@@ -4,18 +4,58 @@ There are tasks to search, check and update proxies in the database.
 
 import os
 import logging
-from datetime import datetime, timedelta
 
 from .proxy_searcher import ProxySearcher
-from .proxy import Proxy, Session
-from .task_manager import TaskManager, BaseTask, PeriodicTask
+from .async_proxy_searcher import AsyncProxySearcher
+from .sharded_searcher import ShardedProxySearcher
+from .scanner import AddressPermutation, PROXY_SCAN_CURSOR_PATH, \
+                     PROXY_SCAN_EXCLUDE, parse_exclude
+from .proxy import Session
+from .task_manager import TaskManager, BaseTask
 from .log import init_logging
-from .thread_pool import ThreadPool
+from .checker import ProxyChecker
 
 
 # The number of threads to search for proxies in ProxySearcher
 PROXY_SEARCH_THREADS = int(os.environ.get('PROXY_SEARCH_THREADS', '100'))
 
+# Engine to search for proxies: 'asyncio' (AsyncProxySearcher) or 'threads'
+# (ProxySearcher)
+PROXY_SEARCH_ENGINE = os.environ.get('PROXY_SEARCH_ENGINE', 'asyncio')
+
+# How to choose addresses to probe: 'random' (random sampling) or
+# 'permutation' (full cycle over IPv4 without repeats, see AddressPermutation)
+PROXY_SEARCH_MODE = os.environ.get('PROXY_SEARCH_MODE', 'permutation')
+
+# The number of probes in flight in AsyncProxySearcher
+PROXY_SEARCH_CONCURRENCY = int(
+    os.environ.get('PROXY_SEARCH_CONCURRENCY', '10000')
+)
+
+# The number of HTTP checks in flight (the second stage of CheckPipeline) in
+# AsyncProxySearcher
+PROXY_VERIFY_CONCURRENCY = int(
+    os.environ.get('PROXY_VERIFY_CONCURRENCY', '500')
+)
+
+# The number of processes (shards) to search for proxies, each one runs
+# AsyncProxySearcher. 0 means the number of CPU cores.
+PROXY_SEARCH_PROCESSES = int(os.environ.get('PROXY_SEARCH_PROCESSES', '1'))
+
+# Bounds of the number of port checks in flight in ProxyChecker (it is
+# adjusted between them at runtime)
+PROXY_CHECK_MIN_CONCURRENCY = int(
+    os.environ.get('PROXY_CHECK_MIN_CONCURRENCY', '10')
+)
+PROXY_CHECK_MAX_CONCURRENCY = int(
+    os.environ.get('PROXY_CHECK_MAX_CONCURRENCY', '1000')
+)
+
+# The number of HTTP checks in flight in ProxyChecker
+PROXY_CHECK_VERIFY_CONCURRENCY = int(
+    os.environ.get('PROXY_CHECK_VERIFY_CONCURRENCY', '100')
+)
+
 
 init_logging()
 task_manager = TaskManager()
@@ -38,11 +78,7 @@ class ProxySearchTask(ProxyTaskMixin, BaseTask):
     """
 
     def run(self):
-        logging.info(
-            f"Start ProxySearcher with {PROXY_SEARCH_THREADS} threads"
-        )
-
-        proxy_searcher = ProxySearcher(PROXY_SEARCH_THREADS)
+        proxy_searcher = self._get_proxy_searcher()
 
         for proxy in proxy_searcher.search():
             logging.info(f"Found proxy {proxy}")
@@ -51,70 +87,63 @@ class ProxySearchTask(ProxyTaskMixin, BaseTask):
                 proxy.create(self.session)
                 logging.info(f"Created proxy {proxy}")
 
+    def _get_proxy_searcher(self):
+        processes = PROXY_SEARCH_PROCESSES or os.cpu_count()
+        exclude = parse_exclude(PROXY_SCAN_EXCLUDE)
+        permutation = PROXY_SEARCH_MODE == 'permutation'
+
+        if processes > 1:
+            # The workers only search, this process is the single writer
+            logging.info(
+                f"Start ShardedProxySearcher with {processes} processes and "
+                f"{PROXY_SEARCH_CONCURRENCY} probes in flight in each one"
+            )
+            return ShardedProxySearcher(
+                processes, PROXY_SEARCH_CONCURRENCY,
+                verify_concurrency=PROXY_VERIFY_CONCURRENCY,
+                cursor_path=PROXY_SCAN_CURSOR_PATH, exclude=exclude,
+                permutation=permutation,
+            )
+
+        if permutation:
+            logging.info(
+                f"Scan addresses with cursor {PROXY_SCAN_CURSOR_PATH}"
+            )
+            scanner = AddressPermutation(
+                ProxySearcher.ports, cursor_path=PROXY_SCAN_CURSOR_PATH,
+                exclude=exclude,
+            )
+        else:
+            scanner = None
+
+        if PROXY_SEARCH_ENGINE == 'threads':
+            logging.info(
+                f"Start ProxySearcher with {PROXY_SEARCH_THREADS} threads"
+            )
+            return ProxySearcher(PROXY_SEARCH_THREADS, scanner)
 
-@task_manager.register
-class UpdateActiveProxyTask(ProxyTaskMixin, PeriodicTask):
-    """
-    Task to check and update active proxies.
-    """
-
-    timeout = 60.0
-    threads_num = 100
-    update_delta = timedelta(hours=1)
-
-    def handle(self):
-        now = datetime.now()
-        proxy_list = [
-            proxy for proxy in Proxy.list_active(self.session)
-            if now - proxy.last_check_at > self.update_delta
-        ]
-
-        pool = ThreadPool(self.threads_num)
-        result = pool.map(Proxy.check, proxy_list)
-
-        for proxy, success in zip(proxy_list, result):
-            if success:
-                logging.info(f"Successfully checked proxy {proxy}")
-                proxy.score_up()
-            else:
-                logging.info(f"Failed proxy {proxy}")
-                proxy.is_active = False
-                proxy.inactive_since = now
-                proxy.score_down()
-            proxy.last_check_at = now
-            self.session.commit()
-            logging.info(f"Proxy {proxy} updated")
+        logging.info(
+            f"Start AsyncProxySearcher with {PROXY_SEARCH_CONCURRENCY} "
+            f"port probes and {PROXY_VERIFY_CONCURRENCY} HTTP checks in flight"
+        )
+        return AsyncProxySearcher(PROXY_SEARCH_CONCURRENCY, scanner,
+                                  PROXY_VERIFY_CONCURRENCY)
 
 
 @task_manager.register
-class UpdateInactiveProxyTask(ProxyTaskMixin, PeriodicTask):
+class ProxyCheckTask(BaseTask):
     """
-    Task to check and update inactive proxies.
+    Task to check active and inactive proxies continuously with
+    ProxyChecker.
     """
 
-    timeout = 60.0
-    threads_num = 100
-
-    def handle(self):
-        now = datetime.now()
-        proxy_list = [
-            proxy for proxy in Proxy.list_inactive(self.session)
-            if now - proxy.last_check_at > \
-                proxy.last_check_at - proxy.inactive_since
-        ]
-
-        pool = ThreadPool(self.threads_num)
-        result = pool.map(Proxy.check, proxy_list)
-
-        for proxy, success in zip(proxy_list, result):
-            if success:
-                logging.info(f"Successfully checked proxy {proxy}")
-                proxy.is_active = True
-                proxy.inactive_since = None
-                proxy.score_up()
-            else:
-                logging.info(f"Failed proxy {proxy}")
-                proxy.score_down()
-            proxy.last_check_at = now
-            self.session.commit()
-            logging.info(f"Proxy {proxy} updated")
+    def run(self):
+        logging.info(
+            f"Start ProxyChecker with {PROXY_CHECK_MIN_CONCURRENCY}-"
+            f"{PROXY_CHECK_MAX_CONCURRENCY} port checks and "
+            f"{PROXY_CHECK_VERIFY_CONCURRENCY} HTTP checks in flight"
+        )
+        checker = ProxyChecker(PROXY_CHECK_MIN_CONCURRENCY,
+                               PROXY_CHECK_MAX_CONCURRENCY,
+                               PROXY_CHECK_VERIFY_CONCURRENCY)
+        checker.run()
@@ -1,15 +1,79 @@
+import os
+import json
+import random
+import gzip
+import socket
+import asyncio
+import tempfile
+import threading
+import socketserver
+from time import sleep, monotonic
+from collections import Counter
+from types import SimpleNamespace
+from datetime import datetime, timedelta
 from unittest import TestCase
 
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
+from . import probe
+from . import proxy as proxy_module
+from . import geoip as geoip_module
 from .proxy_searcher import ProxySearcher
-from .proxy import Proxy
-from .thread_pool import ThreadPool
+from .async_proxy_searcher import AsyncProxySearcher
+from .proxy import Proxy, Latency, MIGRATIONS, migrate, \
+                   set_sqlite_pragmas, get_percentile, get_data_version, \
+                   bump_data_version, log_changes, CHANGE_LOG_RETENTION
+from .thread_pool import ThreadPool, TaskError
+from .utils import LRUCache, AliasTable, SingleFlight
+from .scanner import AddressPermutation
+from .sharded_searcher import ShardedProxySearcher
+from .check_pipeline import CheckPipeline, ConcurrencyController
+from .checker import ProxyChecker
+from .changes import get_changes
+from . import binary
+from . import changes as changes_module
+from .snapshot import ProxySnapshot, ProxySnapshotManager, ProxyRecord, \
+                      get_key, encode_cursor, decode_cursor
+from .geoip import GeoipDB, GeoipDBWriter, prepare_geoip_db, _pack_block
+
+
+class _StubProxyHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request_line = self.rfile.readline()
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+        if request_line.startswith(b'GET http://example.org/ '):
+            self.wfile.write(b'HTTP/1.1 200 OK\r\n'
+                             b'Content-Length: 5\r\n\r\nhello')
+        else:
+            self.wfile.write(b'HTTP/1.1 403 Forbidden\r\n\r\n')
+
+
+class StubProxy(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for an HTTP proxy that only serves http://example.org/.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _StubProxyHandler)
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
 
 
 class ProxySearcherTest(TestCase):
     @classmethod
     def setUpClass(cls):
-        def _try_proxy(proxy):
-            return proxy.host.endswith('5')
+        def _try_proxy(proxy, timeout, sock=None):
+            if sock is not None:
+                sock.close()
+            return 0.1 if proxy.host.endswith('5') else None
 
         cls._old_proxy_try_proxy = Proxy._try_proxy
         Proxy._try_proxy = _try_proxy
@@ -29,3 +93,1311 @@ class ThreadPoolTest(TestCase):
         thread_pool = ThreadPool(10)
         result = thread_pool.map(lambda x: x**2, [1, 2, 3])
         self.assertListEqual(result, [1, 4, 9])
+
+        # The same threads on the next call
+        threads = list(thread_pool._threads)
+        self.assertListEqual(thread_pool.map(lambda x: -x, [1, 2]), [-1, -2])
+        self.assertListEqual(thread_pool._threads, threads)
+        thread_pool.close()
+
+    def test_errors(self):
+        with ThreadPool(2) as thread_pool:
+            result = thread_pool.map(lambda x: 1 / x, [1, 0, 2])
+        self.assertListEqual(
+            result, [1.0, TaskError(0, ZeroDivisionError('division by zero')),
+                     0.5]
+        )
+
+    def test_imap(self):
+        taken = []
+
+        def generate():
+            for x in range(1000):
+                taken.append(x)
+                yield x
+
+        def func(x):
+            sleep(0.001 * (x % 3))
+            return x * 2
+
+        with ThreadPool(4, queue_size=4) as thread_pool:
+            result = thread_pool.imap(func, generate())
+            self.assertListEqual([next(result) for _ in range(3)], [0, 2, 4])
+
+            # The input is consumed lazily
+            self.assertLessEqual(len(taken), 3 + 8)
+
+            self.assertListEqual(list(result), list(range(6, 2000, 2)))
+
+            result = thread_pool.imap_unordered(func, range(100))
+            self.assertListEqual(sorted(result), list(range(0, 200, 2)))
+
+    def test_timeout(self):
+        with ThreadPool(2) as thread_pool:
+            result = list(thread_pool.imap_unordered(
+                sleep, [0.0, 0.5, 0.0], timeout=0.1
+            ))
+            self.assertListEqual(result[:2], [None, None])
+            self.assertIsInstance(result[2], TaskError)
+            self.assertIsInstance(result[2].exception, TimeoutError)
+
+            result = thread_pool.map(sleep, [0.5, 0.0], timeout=0.1)
+            self.assertEqual(result[0], TaskError(0.5, TimeoutError()))
+            self.assertIsNone(result[1])
+
+
+class FakeCheckPipelinePatch:
+    """
+    Replaces the stages of CheckPipeline with fakes: all the ports are open
+    and the proxies with the hosts that end with 5 work.
+    """
+
+    def __init__(self):
+        async def _open_port(pipeline, proxy):
+            await asyncio.sleep(0.001)
+            return object()
+
+        async def _verify(pipeline, proxy, sock, timings):
+            await asyncio.sleep(0.001)
+            timings['ttfb'] = 0.1
+            return proxy.host.endswith('5')
+
+        self._old = CheckPipeline._open_port, CheckPipeline._verify
+        CheckPipeline._open_port = _open_port
+        CheckPipeline._verify = _verify
+
+    def restore(self):
+        CheckPipeline._open_port, CheckPipeline._verify = self._old
+
+
+class ProbeTest(TestCase):
+    def setUp(self):
+        self.stub_proxy = StubProxy()
+
+    def tearDown(self):
+        self.stub_proxy.close()
+
+    def test_parse_status_line(self):
+        self.assertEqual(probe._parse_status_line(b'HTTP/1.1 200 OK'), 200)
+        self.assertEqual(
+            probe._parse_status_line(b'HTTP/1.0 200 Connection established'),
+            200
+        )
+        self.assertIsNone(probe._parse_status_line(b'SSH-2.0-OpenSSH'))
+        self.assertIsNone(probe._parse_status_line(b''))
+
+    def test_try_proxy(self):
+        async def check(url, timings=None):
+            sock = await probe.open_port('127.0.0.1', self.stub_proxy.port,
+                                         1.0)
+            return await probe.try_proxy(sock, url, 1.0, timings=timings)
+
+        timings = {}
+        self.assertTrue(asyncio.run(check('http://example.org/', timings)))
+        self.assertGreater(timings['ttfb'], 0.0)
+        self.assertLess(timings['ttfb'], 1.0)
+        self.assertFalse(asyncio.run(check('http://example.com/')))
+
+    def test_verify(self):
+        sock = socket.create_connection(('127.0.0.1', self.stub_proxy.port))
+        timings = {}
+        self.assertTrue(probe.verify(sock, 'http://example.org/', 1.0,
+                                     timings=timings))
+        self.assertLess(timings['ttfb'], 1.0)
+
+    def test_closed_port(self):
+        port = self.stub_proxy.port
+        self.stub_proxy.close()
+        sock = asyncio.run(probe.open_port('127.0.0.1', port, 1.0))
+        self.assertIsNone(sock)
+        self.stub_proxy = StubProxy()
+
+
+class AsyncProxySearcherTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._patch = FakeCheckPipelinePatch()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._patch.restore()
+
+    def test(self):
+        proxy_searcher = AsyncProxySearcher(100)
+        proxy_list = list(proxy_searcher.search(count=3))
+        self.assertEqual(len(proxy_list), 3)
+        self.assertTrue(all(proxy.host.endswith('5') for proxy in proxy_list))
+
+    def test_break(self):
+        threads_num = threading.active_count()
+        proxy_searcher = AsyncProxySearcher(100)
+        search = proxy_searcher.search()
+        next(search)
+        search.close()
+        self.assertEqual(threading.active_count(), threads_num)
+
+
+class SmallAddressPermutation(AddressPermutation):
+    addresses_num = 256
+    bogon_networks = ()
+
+
+class AddressPermutationTest(TestCase):
+    def test_full_cycle(self):
+        scanner = SmallAddressPermutation(ports=(8080, 3128),
+                                          exclude=('0.0.0.16/28',))
+        visited = [next(scanner) for _ in range(2 * 240)]
+        self.assertEqual(len(set(visited)), 2 * 240)
+        self.assertFalse(any(
+            16 <= int(host.rsplit('.', 1)[1]) < 32 for host, _ in visited
+        ))
+
+    def test_bogons(self):
+        scanner = AddressPermutation(ports=(8080,))
+        for _ in range(1000):
+            host, _ = next(scanner)
+            first = int(host.split('.', 1)[0])
+            self.assertNotIn(first, (0, 10, 127))
+            self.assertLess(first, 224)
+
+    def test_shards(self):
+        shards = [
+            SmallAddressPermutation(ports=(8080, 3128), shard=shard, shards=3,
+                                    seed=42)
+            for shard in range(3)
+        ]
+        visited = []
+        for shard in shards:
+            visited += [next(shard) for _ in range(160)]
+        self.assertEqual(len(set(visited)), 3 * 160)
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as path:
+            cursor_path = os.path.join(path, 'cursor.json')
+            scanner = SmallAddressPermutation(ports=(8080,),
+                                              cursor_path=cursor_path)
+            first = [next(scanner) for _ in range(100)]
+            scanner.save()
+
+            scanner = SmallAddressPermutation(ports=(8080,),
+                                              cursor_path=cursor_path)
+            second = [next(scanner) for _ in range(156)]
+            self.assertEqual(len(set(first + second)), 256)
+
+
+class ShardedProxySearcherTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._patch = FakeCheckPipelinePatch()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._patch.restore()
+
+    def test(self):
+        proxy_searcher = ShardedProxySearcher(2, 10)
+        proxy_searcher.batch_timeout = 0.1
+        proxy_list = list(proxy_searcher.search(count=3))
+        self.assertEqual(len(proxy_list), 3)
+        self.assertTrue(all(proxy.host.endswith('5') for proxy in proxy_list))
+
+
+class CheckPipelineTest(TestCase):
+    def setUp(self):
+        self.stub_proxy = StubProxy()
+
+    def tearDown(self):
+        self.stub_proxy.close()
+
+    def test(self):
+        proxy_list = [
+            Proxy(host='127.0.0.1', port=self.stub_proxy.port),
+            Proxy(host='127.0.0.1', port=1),
+            Proxy(host='127.0.0.1', port=self.stub_proxy.port),
+        ]
+        pipeline = CheckPipeline(port_concurrency=2, verify_concurrency=1,
+                                 url='http://example.org/')
+        result = pipeline.check_many(proxy_list)
+        self.assertListEqual(result, [True, False, True])
+
+    def test_backpressure(self):
+        patch = FakeCheckPipelinePatch()
+        try:
+            proxy_list = [Proxy(host=f'10.0.0.{i}', port=80)
+                          for i in range(100)]
+            pipeline = CheckPipeline(port_concurrency=20, verify_concurrency=2,
+                                     queue_size=3)
+            result = pipeline.check_many(proxy_list)
+        finally:
+            patch.restore()
+        self.assertListEqual(
+            result, [proxy.host.endswith('5') for proxy in proxy_list]
+        )
+
+    def test_adaptive(self):
+        # The stub answers at once, the other port does not answer at all
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            fast = Proxy(host='127.0.0.1', port=self.stub_proxy.port,
+                         latency_p95=0.01)
+            dead = Proxy(host='127.0.0.1', port=server.getsockname()[1],
+                         latency_p95=0.01)
+            pipeline = CheckPipeline(port_concurrency=2, verify_concurrency=2,
+                                     url='http://example.org/', adaptive=True)
+            started_at = monotonic()
+            result = pipeline.check_many([fast, dead])
+            elapsed = monotonic() - started_at
+        finally:
+            server.close()
+        self.assertListEqual(result, [True, False])
+
+        # The dead proxy is given up after MIN_CHECK_TIMEOUT, not 3 seconds
+        self.assertLess(elapsed, 1.5)
+
+
+class ProxyCheckTest(TestCase):
+    def setUp(self):
+        self.stub_proxy = StubProxy()
+        self._old = proxy_module.TRY_URL, proxy_module.TRY_CONTENT
+        proxy_module.TRY_URL = 'http://example.org/'
+
+    def tearDown(self):
+        proxy_module.TRY_URL, proxy_module.TRY_CONTENT = self._old
+        self.stub_proxy.close()
+
+    def test_socket(self):
+        proxy = Proxy(host='127.0.0.1', port=self.stub_proxy.port)
+        self.assertTrue(proxy.check())
+        proxy_module.TRY_CONTENT = 'hello'
+        self.assertTrue(proxy.check())
+        proxy_module.TRY_CONTENT = 'bye'
+        self.assertFalse(proxy.check())
+
+    def test_no_fd_leak(self):
+        # The sockets are closed, even if _try_proxy fails
+        proxy = Proxy(host='127.0.0.1', port=self.stub_proxy.port)
+        sockets = []
+        check_open_port = proxy._check_open_port
+
+        def _check_open_port(timeout):
+            sock = check_open_port(timeout)
+            sockets.append(sock)
+            return sock
+
+        def _try_proxy(timeout, sock=None):
+            raise OSError()
+
+        proxy._check_open_port = _check_open_port
+        self.assertTrue(proxy.check())
+        proxy._try_proxy = _try_proxy
+        with self.assertRaises(OSError):
+            proxy.check()
+        self.assertEqual(len(sockets), 2)
+        self.assertTrue(all(sock.fileno() == -1 for sock in sockets))
+
+    def test_wrong_url(self):
+        proxy_module.TRY_URL = 'http://example.com/'
+        proxy = Proxy(host='127.0.0.1', port=self.stub_proxy.port)
+        self.assertFalse(proxy.check())
+
+    def test_closed_port(self):
+        proxy = Proxy(host='127.0.0.1', port=1)
+        self.assertFalse(proxy.check())
+
+    def test_verify_content(self):
+        sock = socket.create_connection(('127.0.0.1', self.stub_proxy.port))
+        self.assertTrue(probe.verify(sock, 'http://example.org/', 1.0,
+                                     b'hello'))
+        sock = socket.create_connection(('127.0.0.1', self.stub_proxy.port))
+        self.assertFalse(probe.verify(sock, 'http://example.org/', 1.0,
+                                      b'bye'))
+
+
+GEOIP_ROWS = (
+    ('1.0.0.0', '1.0.0.255', 'OC', 'AU', 'Queensland', 'Brisbane'),
+    ('1.0.1.0', '1.0.3.255', 'AS', 'CN', 'Fujian', 'Fuzhou'),
+    ('1.0.4.0', '1.0.7.255', 'OC', 'AU', 'Victoria', 'Melbourne'),
+    ('1.0.8.0', '1.0.15.255', 'AS', 'CN', 'Guangdong', 'Guangzhou'),
+    ('1.0.16.0', '1.0.16.255', 'AS', 'JP', 'Tokyo', 'Tokyo'),
+)
+
+
+def make_geoip_db_v1(path):
+    with open(path, 'wb') as f:
+        for row in GEOIP_ROWS:
+            f.write(_pack_block(*row, 0.0, 0.0))
+
+
+def make_geoip_db_v2(path, rows=GEOIP_ROWS):
+    writer = GeoipDBWriter()
+    for row in rows:
+        writer.add(row[1], row[3], row[4], row[5])
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+class GeoipDBTest(TestCase):
+    version = 1
+    make_geoip_db = staticmethod(make_geoip_db_v1)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'geoip.db')
+        self.make_geoip_db(self.path)
+        self.geoip_db = GeoipDB(self.path)
+        self.assertEqual(self.geoip_db.version, self.version)
+
+    def tearDown(self):
+        del self.geoip_db
+        self.tmp_dir.cleanup()
+
+    def test(self):
+        self.assertDictEqual(self.geoip_db.get_info('1.0.0.7'), {
+            'country': 'AU', 'region': 'Queensland', 'city': 'Brisbane',
+        })
+        self.assertEqual(self.geoip_db.get_info('1.0.2.0')['city'], 'Fuzhou')
+        self.assertEqual(self.geoip_db.get_info('1.0.7.255')['city'],
+                         'Melbourne')
+        self.assertEqual(self.geoip_db.get_info('1.0.16.1')['city'], 'Tokyo')
+        self.assertEqual(self.geoip_db.get_info('1.0.17.1')['city'], '')
+
+    def test_many(self):
+        hosts = [f'1.0.{i}.{i}' for i in range(20)]
+        self.assertListEqual(self.geoip_db.get_info_many(hosts),
+                             list(map(self.geoip_db.get_info, hosts)))
+        self.assertListEqual(self.geoip_db.get_info_many([]), [])
+
+    def test_api(self):
+        from .api import app
+
+        old_instance = GeoipDB._instance
+        GeoipDB._instance = self.geoip_db
+        try:
+            client = app.test_client()
+            response = client.post('/geo', json={
+                'hosts': ['1.0.2.3', 'localhost', '1.0.16.1'],
+            })
+
+            # Conditional GET by the version of the file
+            geo_response = client.get('/geo/1.0.2.3')
+            version = geo_response.get_json()['version']
+            self.assertEqual(geo_response.headers['ETag'], f'"{version}"')
+            not_modified = client.get(
+                '/geo/1.0.2.3', headers={'If-None-Match': f'"{version}"'}
+            )
+        finally:
+            GeoipDB._instance = old_instance
+
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['version'], version)
+        result = response.get_json()['result']
+        self.assertEqual(result[0]['geo']['city'], 'Fuzhou')
+        self.assertIsNone(result[1]['geo'])
+        self.assertEqual(result[2]['geo']['country'], 'JP')
+
+    def test_threads(self):
+        hosts = [f'1.0.{i}.1' for i in range(17)] * 50
+        expected = [self.geoip_db.get_info(host) for host in hosts]
+        with ThreadPool(8) as thread_pool:
+            result = thread_pool.map(self.geoip_db.get_info, hosts)
+        self.assertListEqual(result, expected)
+
+
+class GeoipDBV2Test(GeoipDBTest):
+    version = 2
+    make_geoip_db = staticmethod(make_geoip_db_v2)
+
+    def test_long_strings(self):
+        region = 'Région ' * 20
+        make_geoip_db_v2(self.path, GEOIP_ROWS + (
+            ('1.0.17.0', '1.0.17.255', 'EU', 'FR', region, 'Paris'),
+        ))
+        geoip_db = GeoipDB(self.path)
+        self.assertEqual(geoip_db.get_info('1.0.17.1')['region'], region)
+        self.assertEqual(geoip_db.get_info('1.0.16.1')['city'], 'Tokyo')
+
+    def test_size(self):
+        self.assertLess(os.path.getsize(self.path),
+                        148 * len(GEOIP_ROWS) / 2)
+
+
+class PrepareGeoipDBTest(TestCase):
+    def test(self):
+        with tempfile.TemporaryDirectory() as path:
+            csv_path = os.path.join(path, 'dbip.csv.gz')
+            db_path = os.path.join(path, 'geoip.db')
+            with gzip.open(csv_path, 'wt') as f:
+                f.write('::,::ffff,ZZ,ZZ,,,0,0\n')
+                for row in GEOIP_ROWS:
+                    f.write(','.join(row) + ',1.5,2.5\n')
+
+            progress = []
+            prepare_geoip_db(csv_path, db_path,
+                             lambda *args: progress.append(args))
+
+            self.assertListEqual(sorted(os.listdir(path)),
+                                 ['dbip.csv.gz', 'geoip.db'])
+            self.assertEqual(progress[-1][0], len(GEOIP_ROWS) + 1)
+            geoip_db = GeoipDB(db_path)
+            self.assertEqual(geoip_db.version, 2)
+            self.assertEqual(geoip_db.get_info('1.0.9.1')['city'],
+                             'Guangzhou')
+
+
+class GeoipDBReloadTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'geoip.db')
+        self._old = (geoip_module.GEOIP_DB_PATH,
+                     geoip_module.GEOIP_RELOAD_INTERVAL, GeoipDB._instance)
+        geoip_module.GEOIP_DB_PATH = self.path
+        geoip_module.GEOIP_RELOAD_INTERVAL = 0.0
+        GeoipDB._instance = None
+
+    def tearDown(self):
+        geoip_module.GEOIP_DB_PATH, geoip_module.GEOIP_RELOAD_INTERVAL, \
+            GeoipDB._instance = self._old
+        self.tmp_dir.cleanup()
+
+    def test(self):
+        make_geoip_db_v1(self.path)
+        old_instance = GeoipDB.get_instance()
+        self.assertEqual(old_instance.version, 1)
+        self.assertIs(GeoipDB.get_instance(), old_instance)
+
+        tmp_path = self.path + '.new'
+        make_geoip_db_v2(tmp_path, GEOIP_ROWS[:2])
+        os.replace(tmp_path, self.path)
+
+        # The old instance serves until the new one is loaded
+        self.assertIs(GeoipDB.get_instance(), old_instance)
+        GeoipDB._reload_thread.join()
+
+        new_instance = GeoipDB.get_instance()
+        self.assertEqual(new_instance.version, 2)
+        self.assertEqual(new_instance.get_info('1.0.16.1')['city'], '')
+        self.assertEqual(old_instance.get_info('1.0.16.1')['city'], 'Tokyo')
+
+
+def make_proxy_record(host, country='US', region='Virginia', city='Ashburn',
+                      score=0.5, last_check_at=None, latency=None):
+    now = datetime.now()
+    return ProxyRecord(host=host, port=3128, created_at=now, country=country,
+                       region=region, city=city, score=score,
+                       last_check_at=last_check_at or now, latency=latency,
+                       latency_p95=latency)
+
+
+class ProxySnapshotTest(TestCase):
+    def setUp(self):
+        self.snapshot = ProxySnapshot([
+            make_proxy_record('1.1.1.1', score=0.3, latency=0.4),
+            make_proxy_record('1.1.1.2', 'DE', 'Hesse', 'Frankfurt', 0.9,
+                              latency=0.2),
+            make_proxy_record('1.1.1.3', score=0.7, city='Reston',
+                              latency=1.5),
+            make_proxy_record('1.1.1.4', score=0.1),
+        ])
+
+    def hosts(self, **kwargs):
+        return [record.host for record in self.snapshot.select(**kwargs)]
+
+    def test(self):
+        self.assertListEqual(self.hosts(), ['1.1.1.1', '1.1.1.2', '1.1.1.3',
+                                            '1.1.1.4'])
+        self.assertListEqual(self.hosts(ordered=True),
+                             ['1.1.1.2', '1.1.1.3', '1.1.1.1', '1.1.1.4'])
+        self.assertListEqual(self.hosts(ordered=True, score=0.3),
+                             ['1.1.1.2', '1.1.1.3', '1.1.1.1'])
+        self.assertListEqual(self.hosts(ordered=True, count=2),
+                             ['1.1.1.2', '1.1.1.3'])
+        self.assertListEqual(self.hosts(score=0.5), ['1.1.1.2', '1.1.1.3'])
+        self.assertListEqual(self.hosts(country='US', ordered=True),
+                             ['1.1.1.3', '1.1.1.1', '1.1.1.4'])
+        self.assertListEqual(self.hosts(country='US', city='Ashburn',
+                                        score=0.2), ['1.1.1.1'])
+        self.assertListEqual(self.hosts(region='Hesse'), ['1.1.1.2'])
+        self.assertListEqual(self.hosts(country='FR'), [])
+
+    def test_pack(self):
+        header, records = binary.decode(self.snapshot.pack(score=0.3))
+        self.assertEqual(header, (0, 3))
+        records = list(records)
+        self.assertListEqual([record.host for record in records],
+                             ['1.1.1.2', '1.1.1.3', '1.1.1.1'])
+        self.assertEqual(records[0][1:], (3128, 58982 / 65535, 'DE', 0.2))
+
+        # With filters the records are packed from 'select'
+        for kwargs in ({'country': 'US', 'ordered': True, 'count': 2},
+                       {'ordered': 'latency'}, {'max_latency': 0.5},
+                       {'ordered': True, 'count': 1}):
+            header, records = binary.decode(self.snapshot.pack(**kwargs))
+            self.assertListEqual([record.host for record in records],
+                                 self.hosts(**kwargs))
+            self.assertEqual(header.count, len(self.hosts(**kwargs)))
+
+        header, records = binary.decode(binary.pack(7, [
+            make_proxy_record('example.com', country=''),
+        ]))
+        self.assertEqual(header.version, 7)
+        self.assertEqual(list(records), [
+            binary.Record('0.0.0.0', 3128, 32768 / 65535, '', None),
+        ])
+        with self.assertRaises(ValueError):
+            binary.decode(b'PXL2' + bytes(16))
+        with self.assertRaises(ValueError):
+            binary.decode(binary.pack_header(1, 1))
+
+    def test_after(self):
+        # Pages of 2 records ordered by score
+        self.assertListEqual(
+            self.hosts(count=2, after=(-0.9, '1.1.1.2', 3128)),
+            ['1.1.1.3', '1.1.1.1']
+        )
+        self.assertListEqual(self.hosts(after=(-0.3, '1.1.1.1', 3128)),
+                             ['1.1.1.4'])
+        self.assertListEqual(self.hosts(after=(-0.1, '1.1.1.4', 3128)), [])
+
+        # The key of a record that is not in the snapshot any more
+        self.assertListEqual(self.hosts(after=(-0.8, '9.9.9.9', 3128)),
+                             ['1.1.1.3', '1.1.1.1', '1.1.1.4'])
+
+        # With filters and score
+        self.assertListEqual(
+            self.hosts(country='US', after=(-0.7, '1.1.1.3', 3128)),
+            ['1.1.1.1', '1.1.1.4']
+        )
+        self.assertListEqual(
+            self.hosts(country='US', score=0.2,
+                       after=(-0.7, '1.1.1.3', 3128)),
+            ['1.1.1.1']
+        )
+
+    def test_cursor(self):
+        record = self.snapshot.by_score[0]
+        self.assertTupleEqual(decode_cursor(encode_cursor(record)),
+                              get_key(record))
+        with self.assertRaises(ValueError):
+            decode_cursor('abc')
+        with self.assertRaises(ValueError):
+            decode_cursor(encode_cursor(record)[:-2])
+
+    def test_latency(self):
+        # Unknown latency goes last
+        self.assertListEqual(self.hosts(ordered='latency'),
+                             ['1.1.1.2', '1.1.1.1', '1.1.1.3', '1.1.1.4'])
+        self.assertListEqual(self.hosts(country='US', ordered='latency'),
+                             ['1.1.1.1', '1.1.1.3', '1.1.1.4'])
+        self.assertListEqual(self.hosts(ordered='latency', max_latency=0.5),
+                             ['1.1.1.2', '1.1.1.1'])
+        self.assertListEqual(self.hosts(ordered='latency', score=0.5),
+                             ['1.1.1.2', '1.1.1.3'])
+        self.assertListEqual(self.hosts(max_latency=1.0),
+                             ['1.1.1.1', '1.1.1.2'])
+        self.assertListEqual(self.hosts(ordered=True, max_latency=1.0),
+                             ['1.1.1.2', '1.1.1.1'])
+        self.assertListEqual(
+            self.hosts(country='US', ordered='latency', count=1), ['1.1.1.1']
+        )
+
+    def test_apply(self):
+        snapshot = self.snapshot.apply([
+            make_proxy_record('1.1.1.1', score=0.95, latency=0.1),
+            make_proxy_record('1.1.1.5', 'DE', 'Hesse', 'Frankfurt', 0.7),
+        ], removed=[('1.1.1.2', 3128), ('1.1.1.9', 3128)], version=2)
+        expected = ProxySnapshot(snapshot.records, version=2)
+        self.assertListEqual(
+            sorted(record.host for record in snapshot.records),
+            ['1.1.1.1', '1.1.1.3', '1.1.1.4', '1.1.1.5']
+        )
+        for kwargs in ({'ordered': True}, {'ordered': 'latency'},
+                       {'country': 'DE'}, {'country': 'US', 'ordered': True},
+                       {'region': 'Hesse', 'ordered': 'latency'},
+                       {'city': 'Ashburn', 'score': 0.2},
+                       {'max_latency': 0.5, 'ordered': 'latency'},
+                       {'count': 2, 'after': (-0.95, '1.1.1.1', 3128)}):
+            self.assertListEqual(snapshot.select(**kwargs),
+                                 expected.select(**kwargs))
+        self.assertEqual(snapshot.packed, expected.packed)
+        self.assertEqual(snapshot.pack(score=0.5), expected.pack(score=0.5))
+
+        # The original snapshot is not changed
+        self.assertEqual(len(self.snapshot.select(country='DE')), 1)
+        self.assertEqual(self.snapshot.select(ordered=True)[0].host,
+                         '1.1.1.2')
+
+    def test_sample(self):
+        rng = random.Random(1)
+        counter = Counter(
+            record.host
+            for _ in range(2000)
+            for record in self.snapshot.sample(1, rng=rng)
+        )
+        # In proportion to the score 0.3, 0.9, 0.7, 0.1
+        self.assertGreater(counter['1.1.1.2'], counter['1.1.1.3'])
+        self.assertGreater(counter['1.1.1.3'], counter['1.1.1.1'])
+        self.assertGreater(counter['1.1.1.1'], counter['1.1.1.4'])
+
+        for n in range(6):
+            hosts = [record.host
+                     for record in self.snapshot.sample(n, rng=rng)]
+            self.assertEqual(len(hosts), min(n, 4))
+            self.assertEqual(len(set(hosts)), len(hosts))
+        self.assertSetEqual(
+            {record.host
+             for record in self.snapshot.sample(5, country='US', score=0.2,
+                                                rng=rng)},
+            {'1.1.1.1', '1.1.1.3'}
+        )
+        self.assertListEqual(self.snapshot.sample(1, country='FR'), [])
+
+    def test_alias_table(self):
+        rng = random.Random(1)
+        table = AliasTable([1.0, 0.0, 3.0])
+        counter = Counter(table.draw(rng) for _ in range(4000))
+        self.assertEqual(counter[1], 0)
+        self.assertAlmostEqual(counter[2] / counter[0], 3.0, delta=0.5)
+
+        table = AliasTable([0.0, 0.0])
+        self.assertSetEqual({table.draw(rng) for _ in range(100)}, {0, 1})
+
+
+class ProxyDBTestMixin:
+    """
+    Creates a temporary database with the proxy table.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp_dir.name, 'proxy.db')
+        self.engine = create_engine(f'sqlite:///{path}')
+        event.listen(self.engine, 'connect', set_sqlite_pragmas)
+        migrate(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def insert_proxy(self, host, is_active=True, last_check_at=None,
+                     **kwargs):
+        record = make_proxy_record(host, last_check_at=last_check_at,
+                                   **kwargs)
+        self.engine.execute(Proxy.__table__.insert().values(
+            is_active=is_active, **record._asdict()
+        ))
+
+    def update_proxy(self, host, **values):
+        self.engine.execute(Proxy.__table__.update().where(
+            Proxy.__table__.c.host == host
+        ).values(**values))
+
+    def bump_data_version(self):
+        with self.engine.begin() as conn:
+            return bump_data_version(conn)
+
+
+class MigrateTest(ProxyDBTestMixin, TestCase):
+    def get_indexes(self):
+        return {
+            row[1]
+            for row in self.engine.execute("PRAGMA index_list(proxy)")
+            if not row[1].startswith('sqlite_autoindex')
+        }
+
+    def test(self):
+        self.assertEqual(
+            self.engine.execute("PRAGMA journal_mode").scalar(), 'wal'
+        )
+        self.assertEqual(self.engine.execute("PRAGMA user_version").scalar(),
+                         len(MIGRATIONS))
+        self.assertSetEqual(self.get_indexes(), {
+            index.name for index in Proxy.__table__.indexes
+        })
+
+    def test_old_database(self):
+        # The database created before the indexes and next_check_at
+        now = datetime.now()
+        self.insert_proxy('1.1.1.1', last_check_at=now)
+        self.insert_proxy('1.1.1.2', is_active=False, last_check_at=now)
+        self.update_proxy('1.1.1.2', inactive_since=now - timedelta(hours=3))
+        for name in self.get_indexes():
+            self.engine.execute(f"DROP INDEX {name}")
+        self.engine.execute("ALTER TABLE proxy DROP COLUMN next_check_at")
+        self.engine.execute("PRAGMA user_version=0")
+
+        migrate(self.engine)
+        self.assertSetEqual(self.get_indexes(), {
+            index.name for index in Proxy.__table__.indexes
+        })
+        self.assertEqual(self.engine.execute("PRAGMA user_version").scalar(),
+                         len(MIGRATIONS))
+        table = Proxy.__table__
+        self.assertListEqual(
+            self.engine.execute(
+                select([table.c.next_check_at]).order_by(table.c.host)
+            ).fetchall(),
+            [(now + timedelta(hours=1),), (now + timedelta(hours=3),)]
+        )
+
+        # Nothing to do the second time
+        migrate(self.engine)
+        self.assertEqual(len(self.get_indexes()),
+                         len(Proxy.__table__.indexes))
+
+
+class ProxyLatencyTest(TestCase):
+    def test(self):
+        proxy = Proxy(host='1.1.1.1', port=3128)
+        proxy.add_latency(Latency(0.1, 0.3))
+        self.assertAlmostEqual(proxy.latency, 0.4)
+        self.assertAlmostEqual(proxy.latency_p95, 0.4)
+
+        proxy.add_latency(Latency(0.2, 0.6))
+        self.assertEqual((proxy.connect_time, proxy.ttfb), (0.2, 0.6))
+        self.assertAlmostEqual(proxy.latency, 0.5)
+        self.assertAlmostEqual(proxy.latency_p95, 0.8)
+
+        # Only the recent samples are kept
+        for _ in range(proxy_module.LATENCY_SAMPLES):
+            proxy.add_latency(Latency(0.0, 0.1))
+        self.assertEqual(len(proxy.latency_samples.split(',')),
+                         proxy_module.LATENCY_SAMPLES)
+        self.assertAlmostEqual(proxy.latency_p95, 0.1)
+
+    def test_get_timeouts(self):
+        proxy = Proxy(host='1.1.1.1', port=3128)
+        self.assertTupleEqual(proxy.get_timeouts(), (1.0, 3.0))
+
+        # Fast proxy: a multiple of p95 with floors
+        proxy.latency_p95 = 0.05
+        self.assertTupleEqual(proxy.get_timeouts(), (0.3, 0.5))
+        proxy.latency_p95 = 0.25
+        self.assertTupleEqual(proxy.get_timeouts(), (0.75, 0.75))
+
+        # Slow proxy: not longer than the default timeouts
+        proxy.latency_p95 = 2.0
+        self.assertTupleEqual(proxy.get_timeouts(), (1.0, 3.0))
+
+    def test_percentile(self):
+        self.assertEqual(get_percentile([3, 1, 2], 0.5), 2)
+        self.assertEqual(get_percentile(range(1, 101), 0.95), 95)
+        self.assertEqual(get_percentile([5], 0.95), 5)
+
+
+class DataVersionTest(ProxyDBTestMixin, TestCase):
+    def test(self):
+        with self.engine.connect() as conn:
+            version = get_data_version(conn)
+        self.assertEqual(self.bump_data_version(), version + 1)
+
+        # The writes of proxies bump it
+        path = os.path.join(self.tmp_dir.name, 'geoip.db')
+        make_geoip_db_v2(path)
+        old_instance = GeoipDB._instance
+        GeoipDB._instance = GeoipDB(path)
+        session = sessionmaker(bind=self.engine)()
+        try:
+            Proxy(host='1.0.2.3', port=3128, is_active=True).create(session)
+            Proxy.update_many(session.query(Proxy).all(), engine=self.engine)
+        finally:
+            session.close()
+            GeoipDB._instance = old_instance
+        with self.engine.connect() as conn:
+            self.assertEqual(get_data_version(conn), version + 3)
+
+        # Inactive proxies that stay inactive do not change the version
+        self.insert_proxy('1.1.1.1', is_active=False)
+        session = sessionmaker(bind=self.engine)()
+        proxy = session.query(Proxy).filter_by(host='1.1.1.1').one()
+        proxy.score_down()
+        Proxy.update_many([proxy], engine=self.engine)
+        session.close()
+        with self.engine.connect() as conn:
+            self.assertEqual(get_data_version(conn), version + 3)
+
+
+class ProxySearchTaskTest(ProxyDBTestMixin, TestCase):
+    def test_same_host(self):
+        from .tasks import ProxySearchTask
+
+        # The host is found on both ports
+        found = [Proxy(host='1.0.2.3', port=8080),
+                 Proxy(host='1.0.2.3', port=3128)]
+        path = os.path.join(self.tmp_dir.name, 'geoip.db')
+        make_geoip_db_v2(path)
+        old_instance = GeoipDB._instance
+        GeoipDB._instance = GeoipDB(path)
+        task = ProxySearchTask()
+        task.session.close()
+        task.session = sessionmaker(bind=self.engine)()
+        task._get_proxy_searcher = \
+            lambda: SimpleNamespace(search=lambda: iter(found))
+        try:
+            task.run()
+        finally:
+            task.session.close()
+            GeoipDB._instance = old_instance
+        self.assertListEqual(
+            self.engine.execute(
+                select([Proxy.__table__.c.host, Proxy.__table__.c.port])
+            ).fetchall(),
+            [('1.0.2.3', 8080)]
+        )
+
+
+class ProxyScheduleTest(ProxyDBTestMixin, TestCase):
+    def test(self):
+        now = datetime.now()
+        self.insert_proxy('1.1.1.1')
+        session = sessionmaker(bind=self.engine)()
+        proxy = session.query(Proxy).first()
+        proxy.last_check_at = now
+        proxy.schedule()
+        self.assertEqual(proxy.next_check_at, now + timedelta(hours=1))
+
+        proxy.is_active = False
+        proxy.inactive_since = now - timedelta(minutes=10)
+        proxy.schedule()
+        self.assertEqual(proxy.next_check_at, now + timedelta(minutes=10))
+
+        # Just failed
+        proxy.inactive_since = now
+        proxy.schedule()
+        self.assertEqual(proxy.next_check_at, now + timedelta(minutes=1))
+        session.close()
+
+    def test_list_due(self):
+        now = datetime.now()
+        for idx, minutes in enumerate([5, -5, -10, 0]):
+            self.insert_proxy(f'1.1.1.{idx}')
+            self.update_proxy(f'1.1.1.{idx}', next_check_at=now + \
+                              timedelta(minutes=minutes))
+        self.insert_proxy('1.1.1.9', is_active=False)
+        self.update_proxy('1.1.1.9', next_check_at=now)
+
+        session = sessionmaker(bind=self.engine)()
+        self.assertListEqual(
+            [proxy.host for proxy in Proxy.list_due(session, True, now)],
+            ['1.1.1.2', '1.1.1.1', '1.1.1.3']
+        )
+        self.assertEqual(Proxy.list_due(session, True, now, 1).count(), 1)
+        self.assertEqual(Proxy.get_next_due(session, True),
+                         now - timedelta(minutes=10))
+        self.assertIsNone(Proxy.get_next_due(session, None))
+        session.close()
+
+
+class ConcurrencyControllerTest(TestCase):
+    def test(self):
+        controller = ConcurrencyController(10, 100)
+        delta = Counter(checks=100, successes=20, timeouts=10, waits=5)
+
+        # Saturated and healthy: grow slowly up to max_limit
+        self.assertEqual(controller.get_limit(50, delta, 0.1), 55)
+        self.assertEqual(controller.get_limit(100, delta, 0.1), 100)
+
+        # Not saturated: keep
+        self.assertEqual(
+            controller.get_limit(50, Counter(checks=100, successes=20), 0.1),
+            50
+        )
+
+        # Too many timeouts or the success rate fell
+        self.assertEqual(
+            controller.get_limit(50, Counter(checks=100, timeouts=60), 0.1),
+            37
+        )
+        self.assertEqual(
+            controller.get_limit(50, Counter(checks=100, successes=5), 0.1),
+            37
+        )
+
+        # Out of file descriptors, not less than min_limit
+        self.assertEqual(controller.get_limit(50, delta, 0.9), 25)
+        self.assertEqual(controller.get_limit(15, delta, 0.9), 10)
+
+
+class ProxyCheckerTest(ProxyDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch = FakeCheckPipelinePatch()
+
+    def tearDown(self):
+        self.patch.restore()
+        super().tearDown()
+
+    def test(self):
+        now = datetime.now()
+        for idx in range(20):
+            host = f'1.1.{idx % 2}.{idx}'
+            self.insert_proxy(host, is_active=idx % 2 == 0)
+            self.update_proxy(host, next_check_at=now, inactive_since=now)
+        self.insert_proxy('1.1.9.9')
+        self.update_proxy('1.1.9.9', next_check_at=now + timedelta(hours=1))
+
+        checker = ProxyChecker(5, 10, 5, engine=self.engine)
+        checker.flush_interval = 0.05
+        stop_event = threading.Event()
+        thread = threading.Thread(target=checker.run, args=(stop_event,))
+        thread.start()
+
+        table = Proxy.__table__
+        query = select([table.c.host, table.c.is_active]) \
+            .where(table.c.next_check_at > now) \
+            .order_by(table.c.host)
+        for _ in range(100):
+            rows = self.engine.execute(query).fetchall()
+            if len(rows) == 21:
+                break
+            sleep(0.05)
+        stop_event.set()
+        thread.join()
+
+        # Hosts that end with 5 work
+        self.assertEqual(len(rows), 21)
+        self.assertListEqual(
+            [host for host, is_active in rows if is_active],
+            ['1.1.1.15', '1.1.1.5', '1.1.9.9']
+        )
+
+        # The latency of working proxies is saved
+        latency = self.engine.execute(
+            select([table.c.ttfb]).where(table.c.host == '1.1.1.5')
+        ).scalar()
+        self.assertEqual(latency, 0.1)
+
+
+class ProxyUpdateManyTest(ProxyDBTestMixin, TestCase):
+    def test(self):
+        for idx in range(5):
+            self.insert_proxy(f'1.1.1.{idx}', score=0.5)
+        session = sessionmaker(bind=self.engine)()
+        proxy_list = session.query(Proxy).order_by(Proxy.host).all()
+
+        now = datetime.now()
+        for proxy in proxy_list[:2]:
+            proxy.is_active = False
+            proxy.inactive_since = now
+            proxy.score_down()
+            proxy.last_check_at = now
+
+        Proxy.update_many(proxy_list[:3], engine=self.engine, batch_size=2)
+        session.rollback()
+
+        self.assertListEqual(
+            [(proxy.is_active, proxy.score, proxy.inactive_since)
+             for proxy in session.query(Proxy).order_by(Proxy.host)],
+            [(False, 0.375, now)] * 2 + [(True, 0.5, None)] * 3
+        )
+        session.close()
+
+
+class ChangesTest(ProxyDBTestMixin, TestCase):
+    def hosts(self, records):
+        return [record.host for record in records]
+
+    def test(self):
+        for idx in range(1, 4):
+            self.insert_proxy(f'1.1.1.{idx}', is_active=idx < 3)
+        changes = get_changes(self.engine)
+        self.assertTrue(changes.full)
+        self.assertListEqual(sorted(self.hosts(changes.upserted)),
+                             ['1.1.1.1', '1.1.1.2'])
+        since = changes.version
+
+        # Removed, changed and not seen in the list
+        session = sessionmaker(bind=self.engine)()
+        proxy_list = session.query(Proxy).order_by(Proxy.host).all()
+        proxy_list[0].is_active = False
+        proxy_list[1].score_up()
+        proxy_list[2].score_down()
+        Proxy.update_many(proxy_list, engine=self.engine)
+        session.rollback()
+        session.close()
+
+        changes = get_changes(self.engine, since)
+        self.assertEqual(changes.version, since + 1)
+        self.assertFalse(changes.full)
+        self.assertListEqual(self.hosts(changes.upserted), ['1.1.1.2'])
+        self.assertListEqual(changes.removed, [('1.1.1.1', 3128)])
+
+        self.assertEqual(get_changes(self.engine, changes.version),
+                         (changes.version, False, [], []))
+        self.assertTrue(get_changes(self.engine, changes.version + 1).full)
+
+        # The old changes are removed by retention
+        later = datetime.now() + timedelta(seconds=CHANGE_LOG_RETENTION + 1)
+        with self.engine.begin() as conn:
+            log_changes(conn, bump_data_version(conn), [], now=later)
+        self.assertTrue(get_changes(self.engine, since).full)
+        self.assertFalse(get_changes(self.engine, since + 1).full)
+
+    def test_consistent(self):
+        self.insert_proxy('1.1.1.1')
+        self.insert_proxy('1.1.1.2')
+        since = get_changes(self.engine).version
+        with self.engine.begin() as conn:
+            log_changes(conn, bump_data_version(conn),
+                        [make_proxy_record('1.1.1.1')])
+
+        # A write commits right after the version is read
+        def get_data_version(conn):
+            version = old_get_data_version(conn)
+            with self.engine.begin() as other_conn:
+                log_changes(other_conn, bump_data_version(other_conn),
+                            [make_proxy_record('1.1.1.2')])
+            return version
+
+        old_get_data_version = changes_module.get_data_version
+        changes_module.get_data_version = get_data_version
+        try:
+            changes = get_changes(self.engine, since)
+        finally:
+            changes_module.get_data_version = old_get_data_version
+        self.assertEqual(changes.version, since + 1)
+        self.assertListEqual(self.hosts(changes.upserted), ['1.1.1.1'])
+
+    def test_api(self):
+        from . import api
+
+        self.insert_proxy('1.1.1.1')
+        old_engine = api.engine
+        api.engine = self.engine
+        try:
+            client = api.app.test_client()
+            data = client.get('/changes').get_json()
+            self.assertTrue(data['full'])
+            self.assertEqual(data['upserted'][0]['host'], '1.1.1.1')
+
+            data = client.get(f"/changes?since={data['version']}").get_json()
+            self.assertDictEqual(data, {'version': data['version'],
+                                        'full': False, 'upserted': [],
+                                        'removed': []})
+            response = client.get('/changes?since=abc')
+            self.assertEqual(response.status_code, 400)
+        finally:
+            api.engine = old_engine
+
+
+class CheckApiTest(ProxyDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        from . import api
+
+        self.api = api
+        self.old = (api.engine, api.check_cache, Proxy.check)
+        api.engine = self.engine
+        api.check_cache = LRUCache(16, ttl=3600.0)
+        self.checks = Counter()
+
+        def check(proxy):
+            self.checks[proxy.host] += 1
+            sleep(0.2)
+            return proxy.host != '1.1.1.3'
+
+        Proxy.check = check
+
+    def tearDown(self):
+        self.api.engine, self.api.check_cache, Proxy.check = self.old
+        super().tearDown()
+
+    def get(self, proxy):
+        return self.api.app.test_client().get(f'/check/{proxy}').get_json()
+
+    def test(self):
+        # Checked by the update tasks recently and long ago
+        self.insert_proxy('1.1.1.1', is_active=False,
+                          last_check_at=datetime.now() - timedelta(seconds=5))
+        self.insert_proxy('1.1.1.2',
+                          last_check_at=datetime.now() - timedelta(days=1))
+        data = self.get('1.1.1.1:3128')
+        self.assertFalse(data['result'])
+        self.assertGreaterEqual(data['age'], 5.0)
+        self.assertTrue(self.get('1.1.1.2:3128')['result'])
+        self.assertEqual(self.checks, {'1.1.1.2': 1})
+
+        # Concurrent checks share one probe, the next one is cached
+        threads = [
+            threading.Thread(target=self.get, args=('1.1.1.3:3128',))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        data = self.get('1.1.1.3:3128')
+        self.assertDictEqual(self.checks, {'1.1.1.2': 1, '1.1.1.3': 1})
+        self.assertFalse(data['result'])
+        self.assertGreater(data['age'], 0.0)
+
+    def test_single_flight(self):
+        single_flight = SingleFlight()
+        with self.assertRaises(ZeroDivisionError):
+            single_flight.do('key', lambda: 1 / 0)
+        self.assertEqual(single_flight.do('key', lambda: 1), 1)
+
+        calls = []
+
+        def func():
+            calls.append(1)
+            sleep(0.2)
+            return len(calls)
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(single_flight.do('key', func))
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertListEqual(results, [1] * 5)
+
+        cache = LRUCache(2, ttl=0.1)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        sleep(0.15)
+        self.assertIsNone(cache.get('a'))
+
+
+class ProxySnapshotManagerTest(ProxyDBTestMixin, TestCase):
+    def test(self):
+        self.insert_proxy('1.1.1.1')
+        self.insert_proxy('1.1.1.2', is_active=False)
+        manager = ProxySnapshotManager(self.engine, interval=3600.0)
+
+        snapshot = manager.get()
+        self.assertListEqual(
+            [record.host for record in snapshot.select()], ['1.1.1.1']
+        )
+
+        # Nothing changed, the snapshot is the same
+        manager.refresh()
+        self.assertIs(manager.get(), snapshot)
+
+        # Only an inactive proxy is checked
+        self.update_proxy('1.1.1.2', last_check_at=datetime.now())
+        manager.refresh()
+        self.assertIs(manager.get(), snapshot)
+
+        now = datetime.now() + timedelta(seconds=1)
+        self.update_proxy('1.1.1.1', is_active=False, last_check_at=now)
+        self.update_proxy('1.1.1.2', is_active=True, last_check_at=now)
+        self.insert_proxy('1.1.1.3', last_check_at=now, score=0.9)
+        manager.refresh()
+        self.assertListEqual(
+            [record.host for record in manager.get().select(ordered=True)],
+            ['1.1.1.3', '1.1.1.2']
+        )
+
+    def test_api(self):
+        from . import api
+
+        self.insert_proxy('1.1.1.1', score=0.3)
+        self.insert_proxy('1.1.1.2', score=0.8)
+        old_manager, old_cache = api.snapshot_manager, api.list_cache
+        api.snapshot_manager = ProxySnapshotManager(self.engine,
+                                                    interval=3600.0)
+        api.list_cache = LRUCache(16)
+        try:
+            client = api.app.test_client()
+            response = client.get('/list?format=plain&ordered=1')
+            self.assertEqual(response.data, b'1.1.1.2:3128\n1.1.1.1:3128')
+            response = client.get('/list?score=0.5')
+            result = response.get_json()['result']
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result[0]['host'], '1.1.1.2')
+            self.assertEqual(result[0]['country'], 'US')
+
+            response = client.get('/list?ordered=1&count=1')
+            data = response.get_json()
+            self.assertEqual(data['result'][0]['host'], '1.1.1.2')
+            response = client.get(f"/list?count=1&after={data['cursor']}")
+            data = response.get_json()
+            self.assertEqual(data['result'][0]['host'], '1.1.1.1')
+            response = client.get(f"/list?count=1&after={data['cursor']}")
+            self.assertDictEqual(response.get_json(),
+                                 {'result': [], 'cursor': None})
+            response = client.get('/list?after=abc')
+            self.assertEqual(response.status_code, 400)
+
+            response = client.get('/list?format=ndjson&ordered=1')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = response.data.decode().splitlines()
+            self.assertListEqual(
+                [json.loads(line)['host'] for line in lines],
+                ['1.1.1.2', '1.1.1.1']
+            )
+
+            response = client.get('/list?format=bin&score=0.5')
+            self.assertEqual(response.mimetype, 'application/octet-stream')
+            header, records = binary.decode(response.data)
+            self.assertListEqual([record.host for record in records],
+                                 ['1.1.1.2'])
+            response = client.get('/list?format=bin&ordered=1&count=1')
+            header, records = binary.decode(response.data)
+            self.assertEqual(header.count, 1)
+            self.assertIn('X-Next-Cursor', response.headers)
+
+            response = client.get('/random?n=5')
+            self.assertListEqual(
+                sorted(item['host'] for item in response.get_json()['result']),
+                ['1.1.1.1', '1.1.1.2']
+            )
+            response = client.get('/random?score=0.5&format=plain')
+            self.assertEqual(response.data, b'1.1.1.2:3128')
+        finally:
+            api.snapshot_manager, api.list_cache = old_manager, old_cache
+
+    def test_api_etag(self):
+        from . import api
+
+        self.insert_proxy('1.1.1.1', score=0.3)
+        old_manager, old_cache = api.snapshot_manager, api.list_cache
+        manager = ProxySnapshotManager(self.engine, interval=3600.0)
+        api.snapshot_manager = manager
+        api.list_cache = LRUCache(16)
+        try:
+            client = api.app.test_client()
+            response = client.get('/list?count=10')
+            etag = response.headers['ETag']
+            self.assertEqual(len(api.list_cache), 1)
+            self.assertIsNotNone(
+                api.list_cache.get((manager.get().version, b'count=10'))
+            )
+
+            # Not modified, and another query has another ETag
+            response = client.get('/list?count=10',
+                                  headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            response = client.get('/list?count=5',
+                                  headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+
+            # Served from the cache
+            response = client.get('/list?count=10')
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(len(response.get_json()['result']), 1)
+
+            # A write bumps the version
+            self.insert_proxy('1.1.1.2', score=0.5)
+            self.bump_data_version()
+            manager.refresh()
+            response = client.get('/list?count=10',
+                                  headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertEqual(len(response.get_json()['result']), 2)
+        finally:
+            api.snapshot_manager, api.list_cache = old_manager, old_cache
+
@@ -1,6 +1,15 @@
 """
-ThreadPool implements pool of threads with the method 'map' that applies
-given function for each element of the list passed.
+ThreadPool implements a persistent pool of threads. The threads start on
+the first call and stay alive between calls (until 'close'). The method
+'map' applies given function for each element of the list passed, 'imap'
+and 'imap_unordered' do the same for any iterable (even infinite) and yield
+the results as soon as they are ready. The input is consumed lazily: no more
+than 'threads_num + queue_size' elements are taken in advance.
+
+An error in the function does not break the pool, its result is a TaskError
+object with the element and the exception. If 'timeout' is given, a task
+running longer gets TaskError with TimeoutError (the thread cannot be
+interrupted, so it is busy until the function returns anyway).
 
 Example:
 
@@ -8,63 +17,172 @@ Example:
     result = thread_pool.map(lambda x: x**2, [1, 2, 3])
 
     print(result)  # [1, 4, 9]
+
+    for y in thread_pool.imap_unordered(check, proxies, timeout=5.0):
+        ...
+
+    thread_pool.close()
 """
 
 import threading
-from queue import Queue, Empty
+from time import monotonic
+from queue import Queue
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+
+# How often (in seconds) to look for timed out tasks that have not started
+POLL_INTERVAL = 0.1
+
+
+class TaskError:
+    """
+    Result of a task that failed: 'item' is the element and 'exception' is
+    the error raised by the function (or TimeoutError).
+    """
+
+    def __init__(self, item, exception):
+        self.item = item
+        self.exception = exception
+
+    def __repr__(self):
+        return f"TaskError({self.item!r}, {self.exception!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, TaskError) and self.item == other.item and \
+            type(self.exception) is type(other.exception) and \
+            self.exception.args == other.exception.args
 
 
 class ThreadPool:
-    def __init__(self, threads_num):
+    def __init__(self, threads_num, queue_size=None):
         self._threads_num = threads_num
+        self._queue = Queue(queue_size or threads_num)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
 
-    def map(self, func, lst):
+    def map(self, func, lst, timeout=None):
         """
         Applies 'func' to each element in 'lst'. The result is a list. If
-        an error occurred, None will be stored in the result.
+        an error occurred, TaskError will be stored in the result.
         """
-        # Input queue (elements and their indices)
-        queue = Queue()
-        for i, e in enumerate(lst):
-            queue.put((i, e))
-
-        # Queue for the result
-        result_queue = Queue()
-
-        # Lock to modify result_queue
-        lock = threading.Lock()
-
-        # Target function for a thread
-        def target(queue, result_queue, lock):
-            while True:
-                # Get next element from queue, break if empty
-                try:
-                    idx, x = queue.get(block=False)
-                except Empty:
-                    break
-                else:
-                    # Call 'func', if an error set y to None
-                    try:
-                        y = func(x)
-                    except:
-                        y = None
-
-                    # Fill result_queue
-                    with lock:
-                        result_queue.put((idx, y))
-
-        # Create and execute threads
-        threads = [
-            threading.Thread(target=target, args=(queue, result_queue, lock))
-            for _ in range(self._threads_num)
-        ]
-        list(map(threading.Thread.start, threads))
-        list(map(threading.Thread.join, threads))
-
-        # Fill result list from result_queue
-        result = [None] * len(lst)
-        while not result_queue.empty():
-            idx, y = result_queue.get()
-            result[idx] = y
-
-        return result
+        return list(self.imap(func, lst, timeout))
+
+    def imap(self, func, iterable, timeout=None):
+        """
+        A generator that yields the results of 'func' for the elements of
+        'iterable' in the same order.
+        """
+        window = deque()
+        for item in iterable:
+            window.append(self._submit(func, item))
+            if len(window) >= self._window_size:
+                yield self._result(window.popleft(), timeout)
+        while window:
+            yield self._result(window.popleft(), timeout)
+
+    def imap_unordered(self, func, iterable, timeout=None):
+        """
+        A generator that yields the results of 'func' for the elements of
+        'iterable' in order of completion.
+        """
+        window = set()
+        for item in iterable:
+            window.add(self._submit(func, item))
+            while len(window) >= self._window_size:
+                yield from self._results(window, timeout)
+        while window:
+            yield from self._results(window, timeout)
+
+    def close(self):
+        """
+        Stops the threads after the tasks in the queue.
+        """
+        with self._lock:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    @property
+    def _window_size(self):
+        return self._threads_num + self._queue.maxsize
+
+    def _submit(self, func, item):
+        self._start()
+        future = Future()
+        future.item = item
+        future.started_at = None
+        self._queue.put((future, func, item))
+        return future
+
+    def _start(self):
+        if len(self._threads) < self._threads_num:
+            with self._lock:
+                while len(self._threads) < self._threads_num:
+                    thread = threading.Thread(target=self._work, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            future, func, item = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            future.started_at = monotonic()
+            try:
+                future.set_result(func(item))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def _result(self, future, timeout):
+        while True:
+            wait_timeout = self._get_wait_timeout([future], timeout)
+            done, _ = wait([future], wait_timeout)
+            if done:
+                return _get_result(future)
+            if self._is_expired(future, timeout):
+                return TaskError(future.item, TimeoutError())
+
+    def _results(self, window, timeout):
+        done, _ = wait(window, self._get_wait_timeout(window, timeout),
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            window.discard(future)
+            yield _get_result(future)
+        for future in list(window):
+            if self._is_expired(future, timeout):
+                window.discard(future)
+                yield TaskError(future.item, TimeoutError())
+
+    def _get_wait_timeout(self, futures, timeout):
+        if timeout is None:
+            return None
+        now = monotonic()
+        return min(
+            max(0.0, future.started_at + timeout - now)
+            if future.started_at is not None else POLL_INTERVAL
+            for future in futures
+        )
+
+    def _is_expired(self, future, timeout):
+        return timeout is not None and not future.done() and \
+            future.started_at is not None and \
+            monotonic() - future.started_at >= timeout
+
+
+def _get_result(future):
+    exc = future.exception()
+    if exc is not None:
+        return TaskError(future.item, exc)
+    return future.result()
@@ -2,7 +2,163 @@
 Utils for other modules.
 """
 
+import os
+import random
 import struct
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+class LRUCache:
+    """
+    Thread safe dict with the limited size that drops the least recently
+    used items. If 'ttl' (in seconds) is given, the items expire after that
+    time since 'put'.
+    """
+
+    def __init__(self, size, ttl=None):
+        self._size = size
+        self._ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, expires_at = self._items[key]
+            if expires_at is not None and monotonic() >= expires_at:
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires_at = None if self._ttl is None else monotonic() + self._ttl
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, the others wait for it and get the same result (or the same
+    exception).
+
+    Example:
+
+        single_flight = SingleFlight()
+        result = single_flight.do('1.2.3.4:3128', proxy.check)
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.event.wait()
+        else:
+            try:
+                call.result = func()
+            except BaseException as exc:
+                call.exception = exc
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+
+        if call.exception is not None:
+            raise call.exception
+        return call.result
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class AliasTable:
+    """
+    Walker's alias table to draw indexes 0..n-1 at random in proportion to
+    the weights. It is built in O(n), each draw takes O(1). If all the
+    weights are zero, the draws are uniform.
+    """
+
+    def __init__(self, weights):
+        size = len(weights)
+        total = sum(weights)
+        if total <= 0:
+            weights, total = [1.0] * size, float(size)
+
+        prob = [weight * size / total for weight in weights]
+        self._prob = [1.0] * size
+        self._alias = list(range(size))
+        small = [idx for idx, p in enumerate(prob) if p < 1.0]
+        large = [idx for idx, p in enumerate(prob) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._prob[less] = prob[less]
+            self._alias[less] = more
+            prob[more] += prob[less] - 1.0
+            (small if prob[more] < 1.0 else large).append(more)
+
+    def __len__(self):
+        return len(self._prob)
+
+    def draw(self, rng=random):
+        """
+        Returns a random index. The table must not be empty.
+        """
+        size = len(self._prob)
+        value = rng.random() * size
+        idx = min(int(value), size - 1)
+        if value - idx < self._prob[idx]:
+            return idx
+        return self._alias[idx]
+
+
+def is_ip(s):
+    parts = s.split('.')
+    return len(parts) == 4 and all(
+        part.isascii() and part.isdigit() and len(part) <= 3 and
+        int(part) <= 255
+        for part in parts
+    )
+
+
+def get_fd_usage():
+    """
+    Returns the ratio of open file descriptors of the process to its limit
+    (ulimit -n), or 0.0 if it cannot be measured on this platform.
+    """
+    if resource is None or not os.path.isdir('/proc/self/fd'):
+        return 0.0
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        return 0.0
+    return len(os.listdir('/proc/self/fd')) / soft_limit
 
 
 def ip_to_bytes(ip):